@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import dataclasses
+
+import torch
+
+import inference
+import instrumentation
+
+# Picks sw_batch_size and the torch thread count for this machine.
+#
+# Each candidate runs a few window batches through the model and is scored by windows per second.
+# The fastest candidate that meets the batch latency and memory targets wins, and is cached per
+# hardware / checkpoint / precision so later runs skip the benchmark. overlap and blend mode change
+# the segmentation itself, so they are never tuned here.
+
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "fatvit", "autotune.json")
+BATCH_SIZES = (1, 2, 4, 8, 16)
+
+
+def hardware_key():
+    if inference.device.type == "cuda":
+        name = torch.cuda.get_device_name(inference.device)
+    else:
+        name = platform.processor() or platform.machine()
+    return f"{name}|{os.cpu_count()} cpus|torch {torch.__version__}"
+
+
+def cache_key(model_path, settings, max_batch_latency=None, max_memory_mb=None):
+    # The targets are part of the key, a different target can select a different candidate
+    stat = os.stat(model_path)
+    return "|".join([
+        hardware_key(), os.path.abspath(model_path), str(stat.st_mtime_ns),
+        settings.precision, "x".join(map(str, inference.patch_size)),
+        f"latency={max_batch_latency or 'any'}", f"memory={max_memory_mb or 'auto'}",
+    ])
+
+
+def thread_candidates():
+    if inference.device.type == "cuda":
+        return [0]  # Host threads barely matter on GPU
+    cores = os.cpu_count() or 1
+    return sorted({cores, max(1, cores // 2), max(1, cores // 4)}, reverse=True)
+
+
+def memory_budget_mb():
+    if inference.device.type == "cuda":
+        return torch.cuda.get_device_properties(inference.device).total_memory / 2**20 * 0.9
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20 * 0.75
+    except (AttributeError, ValueError, OSError):
+        return float("inf")  # Unknown, only the latency target applies
+
+
+def benchmark(model, batch_size, num_threads, repeats=3):
+    # peak_memory_mb is this candidate's own peak: GPU memory since the reset below, or the RSS
+    # sampled while it ran on CPU (None if RSS can't be read, then only the latency target applies)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if inference.device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(inference.device)
+    windows = torch.randn(batch_size, inference.model_arch["in_channels"], *inference.patch_size, device=inference.device)
+    with torch.no_grad(), instrumentation.RssMonitor() as memory:
+        model(windows)  # Warm-up
+        if inference.device.type == "cuda":
+            torch.cuda.synchronize(inference.device)
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            model(windows)
+        if inference.device.type == "cuda":
+            torch.cuda.synchronize(inference.device)
+        batch_latency = (time.perf_counter() - start_time) / repeats
+    if inference.device.type == "cuda":
+        peak_memory_mb = torch.cuda.max_memory_allocated(inference.device) / 2**20
+    else:
+        peak_memory_mb = memory.peak_mb
+    return {
+        "sw_batch_size": batch_size,
+        "num_threads": num_threads,
+        "batch_latency": batch_latency,
+        "windows_per_second": batch_size / batch_latency,
+        "peak_memory_mb": peak_memory_mb,
+    }
+
+
+def _load_cache():
+    if not os.path.exists(CACHE_PATH):
+        return {}
+    try:
+        with open(CACHE_PATH, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}  # A broken cache only costs a re-benchmark
+
+
+def _save_cache(cache):
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with open(CACHE_PATH, "w") as file:
+        json.dump(cache, file, indent=4)
+
+
+def autotune(model_path, settings=None, max_batch_latency=None, max_memory_mb=None, use_cache=True, refresh=False, verbose=False):
+    # Returns a copy of settings with the tuned sw_batch_size and num_threads,
+    # refresh re-benchmarks and overwrites a cached result
+    settings = settings or inference.InferenceSettings()
+    key = cache_key(model_path, settings, max_batch_latency, max_memory_mb)
+    cache = _load_cache() if use_cache and not refresh else {}
+    if key in cache:
+        return dataclasses.replace(settings, **cache[key]["settings"])
+
+    model = inference.get_model(model_path, precision=settings.precision)
+    max_memory_mb = max_memory_mb or memory_budget_mb()
+    original_threads = torch.get_num_threads()
+    results = []
+    try:
+        for num_threads in thread_candidates():
+            for batch_size in BATCH_SIZES:
+                try:
+                    result = benchmark(model, batch_size, num_threads)
+                except RuntimeError as e:  # Out of memory
+                    if verbose:
+                        print(f"sw_batch_size={batch_size} threads={num_threads or 'default'}: failed ({e})")
+                    break
+                within_memory = result["peak_memory_mb"] is None or result["peak_memory_mb"] <= max_memory_mb
+                result["meets_target"] = (
+                    within_memory
+                    and (max_batch_latency is None or result["batch_latency"] <= max_batch_latency)
+                )
+                results.append(result)
+                if verbose:
+                    print(f"sw_batch_size={batch_size} threads={num_threads or 'default'}: "
+                          f"{result['windows_per_second']:.2f} windows/s, {result['batch_latency']:.2f} s/batch, "
+                          f"{'unknown' if result['peak_memory_mb'] is None else format(result['peak_memory_mb'], '.0f')} MB peak")
+                if not within_memory:
+                    break  # Larger batches only need more
+    finally:
+        torch.set_num_threads(original_threads)
+
+    candidates = [r for r in results if r["meets_target"]]
+    if not candidates:
+        # Nothing meets the target, fall back to the lightest configuration that ran
+        candidates = sorted(results, key=lambda r: (r["sw_batch_size"], -r["windows_per_second"]))[:1]
+    if not candidates:
+        return settings
+    best = max(candidates, key=lambda r: r["windows_per_second"])
+    tuned = {"sw_batch_size": best["sw_batch_size"], "num_threads": best["num_threads"]}
+
+    if use_cache:
+        cache = _load_cache()
+        cache[key] = {"settings": tuned, "windows_per_second": best["windows_per_second"], "results": results}
+        _save_cache(cache)
+    return dataclasses.replace(settings, **tuned)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and cache the fastest FatViT sliding-window settings for this machine")
+    parser.add_argument("--model", required=True, help="Trained model (.pth, .pt or .onnx)")
+    parser.add_argument("--max-latency", type=float, default=None, help="Maximum seconds per window batch")
+    parser.add_argument("--max-memory", type=float, default=None, help="Memory budget in MB (default: 75%% of RAM, 90%% of GPU memory)")
+    parser.add_argument("--force", action="store_true", help="Re-benchmark even if a cached result exists")
+    parser.add_argument("--write-settings", action="store_true", help=f"Store the result in {inference.SETTINGS_PATH}")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = inference.load_settings()
+    tuned = autotune(args.model, settings, args.max_latency, args.max_memory, refresh=args.force, verbose=True)
+    print(f"Selected sw_batch_size={tuned.sw_batch_size}, num_threads={tuned.num_threads or 'default'}")
+    if args.write_settings:
+        inference.save_settings(tuned)
+        print(f"Saved to {inference.SETTINGS_PATH}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,369 @@
+import os
+import sys
+import csv
+import time
+import queue
+import argparse
+import threading
+import dataclasses
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import nibabel as nib
+
+import inference
+import result_cache
+import instrumentation
+
+# Headless cohort segmentation.
+#
+# Three stages run concurrently and hand cases to each other through bounded queues:
+#   loader thread  -> decode + reorient the next case
+#   main thread    -> sliding-window inference of the current case
+#   saver thread   -> invert, argmax, save and volumetrics of the previous case
+# The queue size bounds how many decoded volumes / logit maps are held in memory at once.
+
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+SUMMARY_FIELDS = ["file_name", "vat_cm3", "sat_cm3", "vat_sat_ratio", "inference_seconds", "mask_path", "status"]
+
+_DONE = object()  # End-of-stream marker passed between stages
+
+# Per-process state of a worker-pool process, set up once by _init_worker
+_worker = {}
+
+
+def collect_inputs(input_path):
+    # A directory is scanned for NIfTI files, anything else is read as a manifest with one path per line
+    if os.path.isdir(input_path):
+        return sorted(
+            os.path.join(input_path, f) for f in os.listdir(input_path)
+            if f.endswith(NIFTI_EXTENSIONS)
+        )
+
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    paths = []
+    with open(input_path, "r") as file:
+        for row in csv.reader(file):
+            if not row or not row[0].strip() or row[0].startswith("#"):
+                continue
+            path = row[0].strip()
+            if not path.endswith(NIFTI_EXTENSIONS):
+                continue  # Skips a header row or other stray entries
+            paths.append(path if os.path.isabs(path) else os.path.join(base_dir, path))
+    return paths
+
+
+def _load_stage(paths, test_transforms, infer_queue, stop_event, cache_context, instruments=None):
+    # cache_context is (model_path, save_path, settings), or None with the result cache off
+    for path in paths:
+        if stop_event.is_set():
+            break
+        timer = instruments.case(path) if instruments is not None else None
+        try:
+            item = {"path": path, "timer": timer}
+            if cache_context is not None:
+                model_path, save_path, settings = cache_context
+                with inference.timed_stage(timer, "cache_lookup"):
+                    item["cache_key"] = result_cache.cache_key(path, model_path, settings)
+                    cached = result_cache.lookup(item["cache_key"], path, save_path)
+                if cached is not None:
+                    item["cached"] = cached  # Skips decoding and inference
+                    infer_queue.put(item)
+                    continue
+            item["data"] = inference.load_case(path, test_transforms, timer)[0]
+        except Exception as e:
+            item = {"path": path, "timer": timer, "error": f"load failed: {e}"}
+        infer_queue.put(item)
+    infer_queue.put(_DONE)
+
+
+def _save_stage(save_queue, post_transforms, save_path, rows, instruments=None):
+    while True:
+        item = save_queue.get()
+        if item is _DONE:
+            break
+        _save_item(item, post_transforms, save_path, rows)
+        timer = item.get("timer")
+        if timer is not None:
+            timer.counts.update(cached="cached" in item, status=rows[-1]["status"])
+            instruments.emit(timer.record())
+
+
+def _save_item(item, post_transforms, save_path, rows):
+    path, timer = item["path"], item.get("timer")
+    if "error" in item:
+        rows.append(_summary_row(path, status=item["error"]))
+        print(f"{os.path.basename(path)}: {item['error']}")
+        return
+    if "cached" in item:
+        result = item["cached"]
+        rows.append(_summary_row(path, result["vat_volume"], result["sat_volume"], result["inference_time"], result["mask_path"]))
+        print(f"{os.path.basename(path)}: VAT {result['vat_volume']:.2f} cm³, SAT {result['sat_volume']:.2f} cm³ (cached)")
+        return
+    try:
+        data = inference.apply_post_transforms(post_transforms, item["data"], timer)
+        mask_path = inference.predicted_mask_path(save_path, path)
+        with inference.timed_stage(timer, "volumetrics"):
+            metrics = inference.compute_volumetrics(data["pred"], inference.label_spacing(data))
+            inference.save_metrics(metrics, inference.metrics_path(mask_path))
+        if "cache_key" in item:
+            with inference.timed_stage(timer, "cache_store"):
+                result_cache.store(item["cache_key"], {
+                    "nii_path": path, "mask_path": mask_path, "metrics": metrics, "inference_time": item["inference_time"],
+                })
+        vat_volume, sat_volume = metrics["vat_cm3"], metrics["sat_cm3"]
+        rows.append(_summary_row(path, vat_volume, sat_volume, item["inference_time"], mask_path))
+        print(f"{os.path.basename(path)}: VAT {vat_volume:.2f} cm³, SAT {sat_volume:.2f} cm³, "
+              f"inference {inference.format_inference_time(item['inference_time'])}")
+    except Exception as e:
+        rows.append(_summary_row(path, status=f"save failed: {e}"))
+        print(f"{os.path.basename(path)}: save failed: {e}")
+
+
+def _summary_row(path, vat_volume=None, sat_volume=None, inference_time=None, mask_path="", status="ok"):
+    ratio = vat_volume / sat_volume if vat_volume is not None and sat_volume else None
+    return {
+        "file_name": os.path.basename(path),
+        "vat_cm3": "" if vat_volume is None else f"{vat_volume:.4f}",
+        "sat_cm3": "" if sat_volume is None else f"{sat_volume:.4f}",
+        "vat_sat_ratio": "" if ratio is None else f"{ratio:.4f}",
+        "inference_seconds": "" if inference_time is None else f"{inference_time:.3f}",
+        "mask_path": mask_path,
+        "status": status,
+    }
+
+
+def write_summary(rows, summary_path):
+    with open(summary_path, mode="w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def run_batch(paths, model_path, save_path, queue_size=2, settings=None, use_cache=True, instruments=None):
+    # instruments: optional instrumentation.Instrumentation receiving one record per case
+    settings = settings or inference.InferenceSettings()
+    inference.apply_settings(settings)
+    os.makedirs(save_path, exist_ok=True)
+    test_transforms = inference.get_test_transforms()
+    post_transforms = inference.get_post_transforms(test_transforms, save_path, settings.low_memory, settings.save_probabilities)
+
+    # Loaded once for the whole run, recorded as a record without a case
+    setup_timer = instruments.case(None) if instruments is not None else None
+    with inference.timed_stage(setup_timer, "model_load"):
+        model = inference.get_model(model_path, precision=settings.precision)
+    if setup_timer is not None:
+        instruments.emit(setup_timer.record())
+
+    infer_queue = queue.Queue(maxsize=queue_size)
+    save_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    rows = []
+
+    cache_context = (model_path, save_path, settings) if use_cache and result_cache.ENABLED else None
+    loader = threading.Thread(target=_load_stage, args=(paths, test_transforms, infer_queue, stop_event, cache_context, instruments), daemon=True)
+    saver = threading.Thread(target=_save_stage, args=(save_queue, post_transforms, save_path, rows, instruments), daemon=True)
+    loader.start()
+    saver.start()
+
+    try:
+        while True:
+            item = infer_queue.get()
+            if item is _DONE:
+                break
+            if "error" not in item and "cached" not in item:
+                data, timer = item["data"], item["timer"]
+                try:
+                    stats = {}
+                    start_time = time.time()
+                    with inference.timed_stage(timer, "inference"):
+                        inference.run_inference(model, data, settings, stats=stats)
+                    item["inference_time"] = time.time() - start_time
+                    if timer is not None:
+                        timer.counts.update(windows=stats["windows"], windows_inferred=stats["windows_inferred"])
+                except Exception as e:
+                    item = {"path": item["path"], "timer": timer, "error": f"inference failed: {e}"}
+            save_queue.put(item)
+    finally:
+        stop_event.set()
+        save_queue.put(_DONE)
+        saver.join()
+
+    # Stages are FIFO, so rows are already in input order
+    return rows
+
+
+# Multi-process mode: every process holds its own resident model, pinned to its own cores.
+# Cases are dispatched largest first so the long ones don't end up last on a single worker.
+
+def case_size(path):
+    # Voxel count from the header, falls back to the file size if the header can't be read
+    try:
+        shape = nib.load(path).shape
+        size = 1
+        for dim in shape:
+            size *= dim
+        return size
+    except Exception:
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def split_cores(workers):
+    # Contiguous core sets, one per worker, or None where CPU affinity is not supported
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    workers = min(workers, len(cores))
+    chunk, extra = divmod(len(cores), workers)
+    core_sets, start = [], 0
+    for i in range(workers):
+        stop = start + chunk + (1 if i < extra else 0)
+        core_sets.append(cores[start:stop])
+        start = stop
+    return core_sets
+
+
+def worker_threads(num_threads, cores, default):
+    # The configured thread count (0: one per pinned core, or default without pinning), at most the pinned cores
+    if cores:
+        return min(num_threads, len(cores)) if num_threads else len(cores)
+    return num_threads or default
+
+
+def _init_worker(core_queue, model_path, settings, use_cache, threads_per_worker, instrumented, profile_dir):
+    cores = core_queue.get()
+    if cores:
+        os.sched_setaffinity(0, cores)
+    settings = dataclasses.replace(settings, num_threads=worker_threads(settings.num_threads, cores, threads_per_worker))
+    inference.apply_settings(settings)
+    _worker.update(model_path=model_path, settings=settings, use_cache=use_cache, instrumented=instrumented, profile_dir=profile_dir)
+    if not use_cache:
+        # Loaded up front, with the cache on it is loaded on the first miss
+        inference.get_model(model_path, precision=settings.precision)
+
+
+def _segment_in_worker(path, save_path):
+    # Returns the summary row and the instrumentation record (None when not instrumented),
+    # records are written by the parent so all workers share one log
+    model_path, settings = _worker["model_path"], _worker["settings"]
+    timer = instrumentation.CaseTimer(path, _worker["profile_dir"]) if _worker["instrumented"] else None
+    if _worker["use_cache"]:
+        result = result_cache.segment_file(path, model_path, save_path, settings=settings, timer=timer)
+    else:
+        model = inference.get_model(model_path, precision=settings.precision)
+        result = inference.segment_file(path, model, save_path, settings=settings, timer=timer)
+    if timer is not None:
+        timer.counts.update(worker=os.getpid(), status="ok")
+    row = _summary_row(path, result["vat_volume"], result["sat_volume"], result["inference_time"], result["mask_path"])
+    return row, timer.record() if timer is not None else None
+
+
+def run_pool(paths, model_path, save_path, workers, settings=None, use_cache=True, instruments=None):
+    settings = settings or inference.InferenceSettings()
+    os.makedirs(save_path, exist_ok=True)
+    core_sets = split_cores(workers)
+    if core_sets is not None:
+        if len(core_sets) < workers:
+            print(f"Using {len(core_sets)} workers instead of {workers}, only {len(core_sets)} CPU cores are available")
+        workers = len(core_sets)
+        smallest, largest = min(map(len, core_sets)), max(map(len, core_sets))
+        if settings.num_threads > smallest:
+            pinned = smallest if smallest == largest else f"{smallest}-{largest}"
+            print(f"num_threads={settings.num_threads} is capped to the {pinned} cores pinned per worker")
+    threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    # spawn: forked torch thread pools and CUDA contexts are not safe to reuse
+    context = multiprocessing.get_context("spawn")
+    core_queue = context.Queue()
+    for cores in core_sets or [None] * workers:
+        core_queue.put(cores)
+
+    order = sorted(paths, key=case_size, reverse=True)
+    rows = {}
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=_init_worker,
+        initargs=(core_queue, model_path, settings, use_cache and result_cache.ENABLED, threads_per_worker,
+                  instruments is not None, instruments.profile_dir if instruments is not None else None),
+    ) as pool:
+        futures = {pool.submit(_segment_in_worker, path, save_path): path for path in order}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                rows[path], record = future.result()
+                if record is not None:
+                    instruments.emit(record)
+                print(f"{os.path.basename(path)}: VAT {rows[path]['vat_cm3']} cm³, SAT {rows[path]['sat_cm3']} cm³")
+            except Exception as e:
+                rows[path] = _summary_row(path, status=f"failed: {e}")
+                print(f"{os.path.basename(path)}: failed: {e}")
+    # One table in input order, whatever order the workers finished in
+    return [rows[path] for path in paths]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="FatViT headless VAT/SAT batch segmentation")
+    parser.add_argument("input", help="Directory of NIfTI files or a manifest with one NIfTI path per line")
+    parser.add_argument("--model", required=True, help="Trained SwinUNETR checkpoint (.pth)")
+    parser.add_argument("--output", required=True, help="Folder for predicted masks and the run summary")
+    parser.add_argument("--summary", default=None, help="Summary CSV path (default: <output>/fatvit_summary.csv)")
+    parser.add_argument("--queue-size", type=int, default=2, help="Cases buffered between pipeline stages")
+    parser.add_argument("--no-cache", action="store_true", help="Always segment, bypassing the result cache")
+    parser.add_argument("--stage-log", default=None, help="Append per-stage timings of every case to this JSON lines file")
+    parser.add_argument("--prometheus", default=None, help="Write running stage totals to this Prometheus textfile")
+    parser.add_argument("--profile-dir", default=None, help="Save a torch.profiler trace of each case's inference here")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes, each with its own model and a share of the CPU cores (1: single-process pipeline)")
+    # Inference settings, unset options fall back to the settings file
+    parser.add_argument("--precision", choices=inference.PRECISIONS, default=None,
+                        help="Forward-pass precision, validate non-fp32 modes with check_precision.py first")
+    parser.add_argument("--sw-batch-size", type=int, default=None, help="Windows per forward pass")
+    parser.add_argument("--overlap", type=float, default=None, help="Sliding-window overlap in [0, 1)")
+    parser.add_argument("--blend-mode", choices=inference.BLEND_MODES, default=None, help="How overlapping windows are blended")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads (0: torch default)")
+    parser.add_argument("--low-memory", action="store_true", default=None, help="Infer in z-slabs and keep only a uint8 label map")
+    parser.add_argument("--save-probabilities", action="store_true", default=None, help="With --low-memory, also save uint8 class probabilities")
+    parser.add_argument("--autotune", action="store_true", help="Pick sw_batch_size and threads by benchmarking (cached per machine)")
+    return parser.parse_args(argv)
+
+
+def build_settings(args):
+    settings = inference.load_settings()
+    overrides = {
+        "precision": args.precision, "sw_batch_size": args.sw_batch_size, "overlap": args.overlap,
+        "blend_mode": args.blend_mode, "num_threads": args.threads,
+        "low_memory": args.low_memory, "save_probabilities": args.save_probabilities,
+    }
+    settings = dataclasses.replace(settings, **{k: v for k, v in overrides.items() if v is not None}).validate()
+    if args.autotune:
+        import autotune
+        settings = autotune.autotune(args.model, settings)
+    return settings
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = collect_inputs(args.input)
+    if not paths:
+        print(f"No NIfTI files found in {args.input}")
+        return 1
+
+    settings = build_settings(args)
+    print(f"Segmenting {len(paths)} volumes on {inference.device} ({settings})")
+    instruments = instrumentation.from_environment(args.stage_log, args.prometheus, args.profile_dir)
+    start_time = time.time()
+    if args.workers > 1:
+        rows = run_pool(paths, args.model, args.output, args.workers, settings=settings, use_cache=not args.no_cache, instruments=instruments)
+    else:
+        rows = run_batch(paths, args.model, args.output, queue_size=max(1, args.queue_size), settings=settings,
+                         use_cache=not args.no_cache, instruments=instruments)
+    summary_path = args.summary or os.path.join(args.output, "fatvit_summary.csv")
+    write_summary(rows, summary_path)
+
+    failed = sum(row["status"] != "ok" for row in rows)
+    print(f"Done in {inference.format_inference_time(time.time() - start_time)}, "
+          f"{len(rows) - failed} ok, {failed} failed. Summary: {summary_path}")
+    return 0 if failed == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import dataclasses
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import nibabel as nib
+import torch
+import monai
+
+import inference
+import instrumentation
+
+# Reproducible benchmark of the segmentation pipeline, no GUI and no trained checkpoint needed.
+#
+# Synthetic abdomen-like volumes (elliptic body in air, a subcutaneous fat ring, visceral fat blobs,
+# LPS orientation so Orientationd has work to do) are written at several matrix sizes and spacings.
+# Each one goes through the same stages as the GUI: model load, decode, reorient, sliding-window
+# SwinUNETR with randomly initialized weights, invert, argmax, save and volumetrics. Stage times are
+# the median over --repeats runs. Every case runs in a fresh process so its peak RSS is its own.
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --baseline baseline.json --save-baseline   # record a baseline
+#   python benchmark.py --baseline baseline.json                   # exits 1 on a regression
+#
+# Baselines are only comparable on the same machine and settings, a hardware mismatch is reported.
+
+# name: (matrix, spacing in mm, storage), typical abdominal MR/CT protocols.
+# "scaled" is int16 with scl_slope/scl_inter set, as dcm2niix writes e.g. Philips MR, it decodes to float64.
+CASES = {
+    "small": ((192, 156, 40), (2.0, 2.0, 5.0), "int16"),
+    "scaled": ((192, 156, 40), (2.0, 2.0, 5.0), "scaled"),
+    "medium": ((256, 208, 60), (1.6, 1.6, 4.0), "int16"),
+    "large": ((320, 260, 80), (1.25, 1.25, 3.0), "int16"),
+}
+
+RESULTS_VERSION = 1
+
+
+def synthetic_volume(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(-1, 1, shape[0]), np.linspace(-1, 1, shape[1]), indexing="ij")
+    blobs = [(rng.uniform(-0.35, 0.35), rng.uniform(-0.25, 0.25), rng.uniform(0.04, 0.1)) for _ in range(12)]
+    volume = np.zeros(shape, dtype=np.float32)
+    for z in range(shape[2]):
+        # The body narrows towards both ends of the stack
+        scale = 0.85 + 0.15 * np.cos(np.pi * (z / max(shape[2] - 1, 1) - 0.5))
+        r = (x / (0.8 * scale)) ** 2 + (y / (0.6 * scale)) ** 2
+        body = r < 1
+        section = np.where(body, 300.0, 0.0)
+        section[body & (r > 0.75)] = 900.0  # Subcutaneous fat
+        for bx, by, radius in blobs:
+            section[body & ((x - bx) ** 2 + (y - by) ** 2 < radius ** 2)] = 800.0  # Visceral fat
+        volume[..., z] = section
+    volume += rng.normal(0, 25, shape).astype(np.float32) * (volume > 0)
+    return np.clip(volume, 0, None).astype(np.int16)
+
+
+def write_case(path, shape, spacing, storage="int16", seed=0):
+    affine = np.diag([-spacing[0], -spacing[1], spacing[2], 1.0])  # LPS, as converted from DICOM
+    volume = synthetic_volume(shape, seed)
+    if storage == "scaled":
+        # Beyond the int16 range, so nibabel stores it with scl_slope/scl_inter set
+        image = nib.Nifti1Image(volume * 40.0 - 10.0, affine)
+        image.set_data_dtype(np.int16)
+    else:
+        image = nib.Nifti1Image(volume, affine)
+    image.header.set_zooms(spacing)
+    nib.save(image, path)
+
+
+def random_checkpoint(path, seed=0):
+    from monai.networks.nets import SwinUNETR
+
+    torch.manual_seed(seed)
+    torch.save(SwinUNETR(**inference.model_arch).state_dict(), path)
+
+
+def environment():
+    import autotune
+
+    return {
+        "hardware": autotune.hardware_key(),
+        "device": str(inference.device),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "monai": monai.__version__,
+        "numpy": np.__version__,
+        "threads": torch.get_num_threads(),
+    }
+
+
+def benchmark_case(name, work_dir, model_path, settings, repeats=3, seed=0):
+    shape, spacing, storage = CASES[name]
+    nii_path = os.path.join(work_dir, f"{name}.nii.gz")
+    save_path = os.path.join(work_dir, f"{name}_out")
+    write_case(nii_path, shape, spacing, storage, seed)
+    voxels = int(np.prod(shape))
+
+    inference.apply_settings(settings)
+    load_timer = instrumentation.CaseTimer(name)
+    with load_timer.stage("model_load"):
+        model = inference.get_model(model_path, precision=settings.precision)
+    with torch.no_grad():
+        # One warm-up batch so one-off costs (allocator, torch.compile) are not in the first run
+        model(torch.zeros((settings.sw_batch_size, 1, *inference.patch_size), device=inference.device))
+
+    runs = []
+    for _ in range(repeats):
+        timer = instrumentation.CaseTimer(name)
+        inference.segment_file(nii_path, model, save_path, settings=settings, timer=timer)
+        runs.append(timer.record())
+
+    stages = {"model_load": dict(load_timer.stages["model_load"], voxels_per_second=None)}
+    for stage in runs[0]["stages"]:
+        wall = statistics.median(run["stages"][stage]["wall_seconds"] for run in runs)
+        stages[stage] = {
+            "wall_seconds": wall,
+            "cpu_seconds": statistics.median(run["stages"][stage]["cpu_seconds"] for run in runs),
+            "peak_rss_mb": instrumentation.max_known(*(run["stages"][stage]["peak_rss_mb"] for run in runs)),
+            "voxels_per_second": voxels / wall if wall else None,
+        }
+    inference_seconds = stages["inference"]["wall_seconds"]
+    return {
+        "shape": list(shape),
+        "spacing": list(spacing),
+        "voxels": voxels,
+        "windows": runs[0]["windows"],
+        "windows_inferred": runs[0]["windows_inferred"],
+        "windows_per_second": runs[0]["windows_inferred"] / inference_seconds if inference_seconds else None,
+        "case_seconds": statistics.median(run["total_wall_seconds"] for run in runs),
+        "peak_rss_mb": instrumentation.max_known(*(run["peak_rss_mb"] for run in runs)),
+        "stages": stages,
+    }
+
+
+def run_benchmark(names, settings=None, repeats=3, seed=0, isolate=True, work_dir=None):
+    settings = settings or inference.InferenceSettings()
+    own_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="fatvit_benchmark_")
+    try:
+        model_path = os.path.join(work_dir, "random_swinunetr.pth")
+        random_checkpoint(model_path, seed)
+        cases = {}
+        for name in names:
+            print(f"Benchmarking {name} {CASES[name][0]} at {CASES[name][1]} mm ({CASES[name][2]})")
+            if isolate:
+                # spawn: a fresh interpreter per case, so peak RSS is not carried over from the last one
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                    cases[name] = pool.submit(benchmark_case, name, work_dir, model_path, settings, repeats, seed).result()
+            else:
+                cases[name] = benchmark_case(name, work_dir, model_path, settings, repeats, seed)
+    finally:
+        if own_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "version": RESULTS_VERSION,
+        "environment": environment(),
+        "settings": dataclasses.asdict(settings),
+        "repeats": repeats,
+        "seed": seed,
+        "cases": cases,
+    }
+
+
+def compare(results, baseline, time_tolerance=0.2, memory_tolerance=0.2, min_seconds=0.05):
+    # Returns (case, stage, metric, baseline value, new value) for every regression. Stages shorter
+    # than min_seconds are ignored, their relative noise is too large to judge.
+    regressions = []
+    for name, case in results["cases"].items():
+        reference = baseline.get("cases", {}).get(name)
+        if reference is None:
+            continue
+        for stage, entry in case["stages"].items():
+            reference_stage = reference["stages"].get(stage)
+            if reference_stage is None:
+                continue
+            old, new = reference_stage["wall_seconds"], entry["wall_seconds"]
+            if new - old > min_seconds and new > old * (1 + time_tolerance):
+                regressions.append((name, stage, "wall_seconds", old, new))
+        peak, reference_peak = case["peak_rss_mb"], reference.get("peak_rss_mb")
+        if peak is not None and reference_peak is not None and peak > reference_peak * (1 + memory_tolerance):
+            regressions.append((name, "case", "peak_rss_mb", reference["peak_rss_mb"], case["peak_rss_mb"]))
+    return regressions
+
+
+def _format_mb(value):
+    return "-" if value is None else f"{value:.0f}"
+
+
+def print_results(results, baseline=None):
+    for name, case in results["cases"].items():
+        reference = (baseline or {}).get("cases", {}).get(name, {}).get("stages", {})
+        print(f"\n{name}: {'x'.join(map(str, case['shape']))} voxels, {'x'.join(map(str, case['spacing']))} mm, "
+              f"{case['windows_inferred']}/{case['windows']} windows inferred, "
+              f"{case['case_seconds']:.2f} s per case, peak RSS {_format_mb(case['peak_rss_mb'])} MB")
+        print(f"  {'stage':<14}{'wall s':>9}{'cpu s':>9}{'Mvox/s':>9}{'RSS MB':>9}{'vs base':>9}")
+        for stage, entry in case["stages"].items():
+            throughput = f"{entry['voxels_per_second'] / 1e6:.2f}" if entry.get("voxels_per_second") else "-"
+            change = "-"
+            if stage in reference and reference[stage]["wall_seconds"]:
+                change = f"{(entry['wall_seconds'] / reference[stage]['wall_seconds'] - 1) * 100:+.0f}%"
+            print(f"  {stage:<14}{entry['wall_seconds']:>9.3f}{entry['cpu_seconds']:>9.3f}{throughput:>9}"
+                  f"{_format_mb(entry['peak_rss_mb']):>9}{change:>9}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the FatViT segmentation pipeline on synthetic volumes")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES), help="Volumes to run")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per case, stage times are the median")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic volumes and the random weights")
+    parser.add_argument("--precision", choices=inference.PRECISIONS, default="fp32", help="Forward-pass precision")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads (0: torch default)")
+    parser.add_argument("--low-memory", action="store_true", help="Benchmark the low-memory slab mode")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results to --baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed stage slowdown as a fraction (0.2: 20%%)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.2, help="Allowed peak RSS increase as a fraction")
+    parser.add_argument("--in-process", action="store_true", help="Run all cases in this process (peak RSS carries over)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Fixed defaults rather than the settings file, so runs on different machines measure the same work
+    settings = dataclasses.replace(
+        inference.InferenceSettings(), precision=args.precision, num_threads=args.threads, low_memory=args.low_memory,
+    ).validate()
+    results = run_benchmark(args.cases, settings, max(1, args.repeats), args.seed, isolate=not args.in_process)
+
+    baseline = None
+    if args.baseline and not args.save_baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=4)
+        print(f"\nSaved baseline to {args.baseline}")
+        return 0
+    if baseline is None:
+        return 0
+
+    if baseline.get("environment", {}).get("hardware") != results["environment"]["hardware"]:
+        print(f"\nWarning: baseline was recorded on {baseline.get('environment', {}).get('hardware')}, "
+              f"times are not comparable")
+    if baseline.get("settings") != results["settings"]:
+        print("\nWarning: baseline was recorded with different settings")
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    if not regressions:
+        print("\nNo regressions against the baseline")
+        return 0
+    print(f"\n{len(regressions)} regression(s) against the baseline:")
+    for name, stage, metric, old, new in regressions:
+        print(f"  {name} {stage} {metric}: {old:.3f} -> {new:.3f} ({(new / old - 1) * 100:+.0f}%)")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
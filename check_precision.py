@@ -0,0 +1,118 @@
+import sys
+import time
+import argparse
+import dataclasses
+
+import torch
+
+import inference
+
+# Accuracy gate for the reduced-precision inference modes.
+#
+# Every mode segments the same reference volume and is compared against the fp32 result:
+# VAT/SAT volume difference and per-class Dice. A mode should only be used in production
+# once it passes on a representative reference scan. Every mode runs with the configured
+# sliding-window settings (settings file plus CLI overrides), the ones production uses.
+
+
+def dice(pred, ref, label):
+    pred_mask = pred == label
+    ref_mask = ref == label
+    total = int(pred_mask.sum()) + int(ref_mask.sum())
+    if total == 0:
+        return 1.0  # Both empty
+    return 2.0 * int((pred_mask & ref_mask).sum()) / total
+
+
+def segment_reference(data, model, settings):
+    # Labels in the reoriented space, the orientation inversion does not change voxel counts or overlap
+    with torch.no_grad():
+        # One warm-up batch so one-off costs (torch.compile, allocator) are not timed
+        model(torch.zeros((settings.sw_batch_size, 1, *inference.patch_size), device=inference.device))
+    start_time = time.time()
+    logits = inference.predict(model, data["image"].unsqueeze(0), settings=settings)
+    elapsed = time.time() - start_time
+    return logits[0].argmax(dim=0).cpu(), elapsed
+
+
+def check_precisions(model_path, reference_path, precisions, max_volume_diff=1.0, min_dice=0.98, settings=None):
+    settings = settings or inference.load_settings()
+    inference.apply_settings(settings)
+    data = inference.get_test_transforms()({"image": reference_path})
+    pixdim = data["image"].meta["pixdim"][1:4]
+
+    ref_labels, ref_time = segment_reference(data, inference.get_model(model_path, precision="fp32"), settings)
+    ref_vat, ref_sat = inference.compute_volumes(ref_labels, pixdim)
+
+    results = [{
+        "precision": "fp32", "vat_cm3": ref_vat, "sat_cm3": ref_sat, "vat_diff_pct": 0.0, "sat_diff_pct": 0.0,
+        "vat_dice": 1.0, "sat_dice": 1.0, "seconds": ref_time, "speedup": 1.0, "passed": True, "error": "",
+    }]
+    for precision in precisions:
+        if precision == "fp32":
+            continue
+        try:
+            labels, elapsed = segment_reference(data, inference.get_model(model_path, precision=precision), settings)
+        except Exception as e:
+            results.append({"precision": precision, "passed": False, "error": str(e)})
+            continue
+        vat, sat = inference.compute_volumes(labels, pixdim)
+        vat_diff = abs(vat - ref_vat) / ref_vat * 100 if ref_vat else 0.0
+        sat_diff = abs(sat - ref_sat) / ref_sat * 100 if ref_sat else 0.0
+        vat_dice = dice(labels, ref_labels, inference.VAT_LABEL)
+        sat_dice = dice(labels, ref_labels, inference.SAT_LABEL)
+        results.append({
+            "precision": precision, "vat_cm3": vat, "sat_cm3": sat, "vat_diff_pct": vat_diff, "sat_diff_pct": sat_diff,
+            "vat_dice": vat_dice, "sat_dice": sat_dice, "seconds": elapsed, "speedup": ref_time / elapsed if elapsed else 0.0,
+            "passed": max(vat_diff, sat_diff) <= max_volume_diff and min(vat_dice, sat_dice) >= min_dice,
+            "error": "",
+        })
+    return results
+
+
+def print_results(results):
+    print(f"{'precision':<14}{'VAT cm³':>10}{'SAT cm³':>10}{'VAT Δ%':>8}{'SAT Δ%':>8}{'VAT Dice':>10}{'SAT Dice':>10}{'sec':>8}{'speedup':>9}  result")
+    for r in results:
+        if r["error"]:
+            print(f"{r['precision']:<14}  failed to run: {r['error']}")
+            continue
+        print(f"{r['precision']:<14}{r['vat_cm3']:>10.2f}{r['sat_cm3']:>10.2f}{r['vat_diff_pct']:>8.2f}{r['sat_diff_pct']:>8.2f}"
+              f"{r['vat_dice']:>10.4f}{r['sat_dice']:>10.4f}{r['seconds']:>8.2f}{r['speedup']:>9.2f}  {'PASS' if r['passed'] else 'FAIL'}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare FatViT reduced-precision modes against fp32 on a reference volume")
+    parser.add_argument("reference", help="Reference NIfTI volume")
+    parser.add_argument("--model", required=True, help="Trained SwinUNETR checkpoint (.pth)")
+    parser.add_argument("--precision", nargs="+", choices=inference.PRECISIONS, default=[p for p in inference.PRECISIONS if p != "fp32"],
+                        help="Modes to check (default: all)")
+    parser.add_argument("--max-volume-diff", type=float, default=1.0, help="Maximum VAT/SAT volume difference in percent")
+    parser.add_argument("--min-dice", type=float, default=0.98, help="Minimum VAT/SAT Dice against fp32")
+    # Sliding-window settings, unset options fall back to the settings file
+    parser.add_argument("--sw-batch-size", type=int, default=None, help="Windows per forward pass")
+    parser.add_argument("--overlap", type=float, default=None, help="Sliding-window overlap in [0, 1)")
+    parser.add_argument("--blend-mode", choices=inference.BLEND_MODES, default=None, help="How overlapping windows are blended")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads (0: torch default)")
+    return parser.parse_args(argv)
+
+
+def build_settings(args):
+    settings = inference.load_settings()
+    overrides = {
+        "sw_batch_size": args.sw_batch_size, "overlap": args.overlap,
+        "blend_mode": args.blend_mode, "num_threads": args.threads,
+    }
+    return dataclasses.replace(settings, **{k: v for k, v in overrides.items() if v is not None}).validate()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = build_settings(args)
+    print(f"Checking with {settings}")
+    results = check_precisions(args.model, args.reference, args.precision, args.max_volume_diff, args.min_dice, settings)
+    print_results(results)
+    return 0 if all(r["passed"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
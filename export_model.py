@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import argparse
+
+import torch
+
+import inference
+
+# One-time export of a trained .pth checkpoint to a frozen graph for the fixed patch size.
+# The result can be passed anywhere a model path is accepted (GUI, batch_segment.py, ...),
+# inference.get_model picks the runtime from the file extension:
+#   .pt / .ts  -> TorchScript
+#   .onnx      -> ONNX Runtime (no MONAI network code needed at inference time)
+# Newer torch versions write ONNX weights to a <name>.onnx.data file next to the graph, keep the two together.
+
+FORMAT_EXTENSIONS = {"torchscript": ".pt", "onnx": ".onnx"}
+
+
+def export_torchscript(model, example, output_path):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    meta = {"batch_size": example.shape[0], "patch_size": list(example.shape[2:])}
+    torch.jit.save(traced, output_path, _extra_files={"fatvit.json": json.dumps(meta)})
+
+
+def export_onnx(model, example, output_path, opset_version=17):
+    with torch.no_grad():
+        torch.onnx.export(
+            model, (example,), output_path,
+            input_names=["image"], output_names=["logits"],
+            opset_version=opset_version,
+        )
+
+
+def export_model(model_path, output_path, export_format="torchscript", batch_size=None):
+    # Exports on CPU so the graph is not tied to the GPU it was exported on
+    model = inference.load_model(model_path).cpu()
+    batch_size = batch_size or inference.sw_batch_size
+    example = torch.randn(batch_size, inference.model_arch["in_channels"], *inference.patch_size)
+
+    if export_format == "torchscript":
+        export_torchscript(model, example, output_path)
+    elif export_format == "onnx":
+        export_onnx(model, example, output_path)
+    else:
+        raise ValueError(f"Unknown export format '{export_format}'")
+
+    # Check the exported graph reproduces the eager logits
+    exported = inference.load_exported_model(output_path)
+    with torch.no_grad():
+        expected = model(example).to(inference.device)
+        max_diff = float((exported(example) - expected).abs().max())
+    return max_diff
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export a FatViT SwinUNETR checkpoint to TorchScript or ONNX")
+    parser.add_argument("model", help="Trained SwinUNETR checkpoint (.pth)")
+    parser.add_argument("--format", choices=sorted(FORMAT_EXTENSIONS), default="torchscript", help="Export format")
+    parser.add_argument("--output", default=None, help="Output path (default: next to the checkpoint)")
+    parser.add_argument("--batch-size", type=int, default=inference.sw_batch_size,
+                        help="Windows per forward pass the graph is exported for, should match sw_batch_size")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_path = args.output or os.path.splitext(args.model)[0] + FORMAT_EXTENSIONS[args.format]
+    max_diff = export_model(args.model, output_path, args.format, args.batch_size)
+    print(f"Exported {args.model} to {output_path} ({args.format}), max abs logit difference vs eager: {max_diff:.2e}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
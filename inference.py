@@ -0,0 +1,668 @@
+import os
+import copy
+import json
+import math
+import time
+import threading
+import contextlib
+import dataclasses
+import numpy as np
+import torch
+
+from monai.transforms import Compose, LoadImaged, SaveImaged, EnsureChannelFirstd, Orientationd, Invertd, AsDiscreted
+from monai.inferers import sliding_window_inference
+from monai.utils import convert_to_dst_type
+
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+num_classes = 3
+patch_size = (64, 64, 32)
+sw_batch_size = 4
+overlap = 0.25  # MONAI sliding_window_inference default
+
+# Forward-pass precision modes, see prepare_model
+PRECISIONS = ("fp32", "bf16", "int8", "channels_last", "compiled")
+BLEND_MODES = ("constant", "gaussian")
+
+# Settings file read by the GUI and used as the CLI defaults, FATVIT_SETTINGS overrides the path
+SETTINGS_PATH = os.environ.get("FATVIT_SETTINGS", "fatvit_settings.json")
+
+# SwinUNETR architecture the checkpoints were trained with
+model_arch = dict(
+    img_size=patch_size,
+    in_channels=1,
+    out_channels=num_classes,
+    feature_size=48,
+    spatial_dims=3,
+)
+
+# Label values written by the model
+SAT_LABEL = 2
+VAT_LABEL = 1
+
+# Logit given to the background class for windows that are skipped as air
+BACKGROUND_LOGIT = 20.0
+
+
+@dataclasses.dataclass
+class InferenceSettings:
+    sw_batch_size: int = sw_batch_size
+    overlap: float = overlap
+    blend_mode: str = "constant"
+    num_threads: int = 0  # torch intra-op threads, 0 keeps torch's default
+    precision: str = "fp32"
+    # Voxels above this fraction of the 99th intensity percentile count as body, 0 runs every window
+    foreground_threshold: float = 0.05
+    foreground_margin: int = 8  # Voxels kept around the body bounding box
+    # Low-memory mode: infer in z-slabs and keep only a uint8 label map (and optionally uint8 probabilities)
+    low_memory: bool = False
+    slab_depth: int = 96
+    save_probabilities: bool = False
+
+    def validate(self):
+        if self.sw_batch_size < 1:
+            raise ValueError("sw_batch_size must be at least 1")
+        if not 0 <= self.overlap < 1:
+            raise ValueError("overlap must be in [0, 1)")
+        if self.blend_mode not in BLEND_MODES:
+            raise ValueError(f"Unknown blend mode '{self.blend_mode}', expected one of {', '.join(BLEND_MODES)}")
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{self.precision}', expected one of {', '.join(PRECISIONS)}")
+        if not 0 <= self.foreground_threshold < 1:
+            raise ValueError("foreground_threshold must be in [0, 1)")
+        if self.slab_depth < 1:
+            raise ValueError("slab_depth must be at least 1")
+        if self.save_probabilities and not self.low_memory:
+            raise ValueError("save_probabilities requires low_memory")
+        return self
+
+
+def load_settings(path=None):
+    # Missing file means defaults, unknown keys are ignored so older builds can read newer files
+    path = path or SETTINGS_PATH
+    if not os.path.exists(path):
+        return InferenceSettings()
+    with open(path, "r") as file:
+        values = json.load(file)
+    fields = {f.name for f in dataclasses.fields(InferenceSettings)}
+    return InferenceSettings(**{k: v for k, v in values.items() if k in fields}).validate()
+
+
+def save_settings(settings, path=None):
+    with open(path or SETTINGS_PATH, "w") as file:
+        json.dump(dataclasses.asdict(settings), file, indent=4)
+
+
+def apply_settings(settings):
+    # Process-wide, call once before running inference
+    if settings.num_threads:
+        torch.set_num_threads(settings.num_threads)
+
+
+def get_test_transforms():
+    # The volume is decoded once, in its native dtype (e.g. int16), and this copy is shared by
+    # inference, inversion and volumetrics. predict casts only the tiled region to float.
+    return Compose([
+        LoadImaged(keys=["image"], dtype=None),
+        EnsureChannelFirstd(keys=["image"]),
+        Orientationd(keys=["image"], axcodes="RAS"),
+    ])
+
+
+# Stage names of the post transforms in instrumentation records, see apply_post_transforms
+POST_TRANSFORM_STAGES = {Invertd: "invert", AsDiscreted: "argmax", SaveImaged: "save"}
+
+
+def get_post_transforms(test_transforms, save_path, low_memory=False, save_probabilities=False):
+    if not low_memory:
+        return Compose([
+            Invertd(
+                keys="pred",
+                transform=test_transforms,
+                orig_keys="image",
+                meta_keys="pred_meta_dict",
+                orig_meta_keys="image_meta_dict",
+                meta_key_postfix="meta_dict",
+                nearest_interp=False,
+                to_tensor=True,
+                device=device,
+            ),
+            AsDiscreted(keys="pred", argmax=True),
+            SaveImaged(keys="pred", meta_keys="pred_meta_dict", output_dir=save_path, output_ext=".nii", output_postfix="pred", separate_folder=False, resample=False),
+        ])
+
+    # "pred" already holds the uint8 label map (see predict_labels), it is only reoriented and saved
+    keys = ["pred", "prob"] if save_probabilities else ["pred"]
+    transforms = [
+        Invertd(
+            keys=keys,
+            transform=test_transforms,
+            orig_keys="image",
+            meta_keys=[f"{key}_meta_dict" for key in keys],
+            orig_meta_keys="image_meta_dict",
+            meta_key_postfix="meta_dict",
+            nearest_interp=True,
+            to_tensor=True,
+            device=device,
+        ),
+        SaveImaged(keys="pred", meta_keys="pred_meta_dict", output_dir=save_path, output_ext=".nii", output_postfix="pred", output_dtype=np.uint8, separate_folder=False, resample=False),
+    ]
+    if save_probabilities:
+        transforms.append(
+            SaveImaged(keys="prob", meta_keys="prob_meta_dict", output_dir=save_path, output_ext=".nii", output_postfix="prob", output_dtype=np.uint8, separate_folder=False, resample=False),
+        )
+    return Compose(transforms)
+
+
+def load_model(model_path, arch=None):
+    from monai.networks.nets import SwinUNETR  # Only needed for eager checkpoints, not exported graphs
+
+    model = SwinUNETR(**(arch or model_arch))
+    state_dict = torch.load(model_path, map_location=device)
+    new_state_dict = {k.replace('module.', ''): v for k, v in state_dict.items()}
+
+    model.load_state_dict(new_state_dict)
+    model = model.to(device)
+    model.eval()
+    return model
+
+
+class ExportedModel:
+    # Frozen graph exported by export_model.py for a fixed (batch, 1, *patch_size) input.
+    # Smaller window batches are zero-padded up to the exported batch size.
+    def __init__(self, batch_size, exported_patch_size):
+        if tuple(exported_patch_size) != tuple(patch_size):
+            raise ValueError(f"Model was exported for patch size {tuple(exported_patch_size)}, expected {patch_size}")
+        self.batch_size = batch_size
+
+    def run(self, windows):
+        raise NotImplementedError
+
+    def __call__(self, windows):
+        outputs = []
+        for start in range(0, windows.shape[0], self.batch_size):
+            chunk = windows[start:start + self.batch_size]
+            count = chunk.shape[0]
+            if count < self.batch_size:
+                padding = chunk.new_zeros((self.batch_size - count, *chunk.shape[1:]))
+                chunk = torch.cat([chunk, padding])
+            outputs.append(self.run(chunk.float().contiguous())[:count])
+        return torch.cat(outputs)
+
+
+class TorchScriptModel(ExportedModel):
+    def __init__(self, model_path):
+        extra_files = {"fatvit.json": ""}
+        self.module = torch.jit.load(model_path, map_location=device, _extra_files=extra_files)
+        self.module.eval()
+        meta = json.loads(extra_files["fatvit.json"] or "{}")
+        super().__init__(meta.get("batch_size", sw_batch_size), meta.get("patch_size", patch_size))
+
+    def run(self, windows):
+        return self.module(windows.to(device))
+
+
+class OnnxModel(ExportedModel):
+    def __init__(self, model_path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("onnxruntime is required to run .onnx models: pip install onnxruntime")
+        providers = ["CPUExecutionProvider"]
+        if device.type == "cuda" and "CUDAExecutionProvider" in onnxruntime.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = onnxruntime.InferenceSession(model_path, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        shape = self.session.get_inputs()[0].shape  # (batch, 1, *patch_size)
+        super().__init__(shape[0], shape[2:])
+
+    def run(self, windows):
+        output = self.session.run(None, {self.input_name: windows.cpu().numpy()})[0]
+        return torch.from_numpy(output).to(device)
+
+
+# Exported graph formats by file extension, anything else is loaded as an eager .pth checkpoint
+EXPORTED_MODELS = {".pt": TorchScriptModel, ".ts": TorchScriptModel, ".onnx": OnnxModel}
+
+
+def is_exported_model(model_path):
+    return os.path.splitext(model_path)[1].lower() in EXPORTED_MODELS
+
+
+def load_exported_model(model_path):
+    return EXPORTED_MODELS[os.path.splitext(model_path)[1].lower()](model_path)
+
+
+class PrecisionModel(torch.nn.Module):
+    # Runs the wrapped model under autocast and/or a memory format, always returning fp32 logits
+    def __init__(self, model, autocast_dtype=None, memory_format=None):
+        super().__init__()
+        self.model = model
+        self.autocast_dtype = autocast_dtype
+        self.memory_format = memory_format
+
+    def forward(self, x):
+        if self.memory_format is not None:
+            x = x.contiguous(memory_format=self.memory_format)
+        if self.autocast_dtype is None:
+            return self.model(x)
+        with torch.autocast(device_type=device.type, dtype=self.autocast_dtype):
+            return self.model(x).float()
+
+
+def prepare_model(model, precision="fp32"):
+    # Returns a model for the requested precision mode, the fp32 model passed in is left untouched
+    if precision == "fp32":
+        return model
+    if precision == "bf16":
+        return PrecisionModel(model, autocast_dtype=torch.bfloat16).eval()
+    if precision == "int8":
+        # Dynamic quantization covers the nn.Linear layers, i.e. the Swin attention qkv/proj and MLPs
+        if device.type != "cpu":
+            raise ValueError("int8 dynamic quantization is only supported on CPU")
+        quantized = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8)
+        return quantized.eval()
+    if precision in ("channels_last", "compiled"):
+        channels_last = copy.deepcopy(model).to(memory_format=torch.channels_last_3d)
+        prepared = PrecisionModel(channels_last, memory_format=torch.channels_last_3d).eval()
+        if precision == "compiled":
+            prepared = torch.compile(prepared)
+        return prepared
+    raise ValueError(f"Unknown precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+
+
+# Resident models, one entry per checkpoint path and precision: {(path, precision): (key, model)}
+_model_cache = {}
+_model_cache_lock = threading.RLock()
+
+
+def _model_key(model_path, arch):
+    # A rewritten checkpoint changes mtime/size, so the cached model is rebuilt on next use
+    stat = os.stat(model_path)
+    return (stat.st_mtime_ns, stat.st_size, tuple(sorted(arch.items())))
+
+
+def get_model(model_path, arch=None, precision="fp32"):
+    arch = arch or model_arch
+    model_path = os.path.abspath(model_path)
+    key = _model_key(model_path, arch)
+    # Held for the whole load so a warm-up in flight is waited on rather than duplicated
+    with _model_cache_lock:
+        cached = _model_cache.get((model_path, precision))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        if is_exported_model(model_path):
+            if precision != "fp32":
+                raise ValueError("Exported models run at the precision they were exported with, use precision 'fp32'")
+            model = load_exported_model(model_path)
+        elif precision == "fp32":
+            model = load_model(model_path, arch)
+        else:
+            model = prepare_model(get_model(model_path, arch, "fp32"), precision)
+        _model_cache[(model_path, precision)] = (key, model)
+        return model
+
+
+def warm_up_model(model_path, arch=None, precision="fp32"):
+    # Loads the model in the background so the first prediction does not pay for it
+    def _warm_up():
+        try:
+            get_model(model_path, arch, precision)
+        except Exception as e:
+            print(f"Error warming up model: {e}")
+
+    thread = threading.Thread(target=_warm_up, daemon=True)
+    thread.start()
+    return thread
+
+
+def clear_model_cache():
+    with _model_cache_lock:
+        _model_cache.clear()
+
+
+class InferenceCancelled(Exception):
+    pass
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise InferenceCancelled()
+
+
+def count_windows(image_size, roi_size=patch_size, overlap=overlap):
+    # Same tiling as MONAI's sliding_window_inference, images smaller than the ROI are padded up to it
+    count = 1
+    for size, roi in zip(image_size, roi_size):
+        size = max(size, roi)
+        interval = roi if size == roi else max(int(roi * (1 - overlap)), 1)
+        count *= math.ceil((size - roi) / interval) + 1
+    return count
+
+
+def foreground_threshold(inputs, fraction):
+    # Relative to a high percentile so it does not depend on the scanner's intensity scale.
+    # torch.quantile has an input size limit, a strided sample is plenty for a percentile.
+    flat = inputs.reshape(-1)
+    sample = flat[::max(1, flat.numel() // 1_000_000)].float()
+    return float(torch.quantile(sample, 0.99)) * fraction
+
+
+def foreground_crop(inputs, threshold, margin):
+    # Spatial slices of the body bounding box plus margin, grown to at least the patch size.
+    # None if nothing is above the threshold.
+    body = (inputs > threshold).flatten(0, 1).any(dim=0)
+    if not body.any():
+        return None
+    crop = []
+    for axis, (size, roi) in enumerate(zip(body.shape, patch_size)):
+        other_axes = tuple(a for a in range(body.ndim) if a != axis)
+        indices = torch.nonzero(body.sum(dim=other_axes) > 0).flatten()
+        start = max(int(indices[0]) - margin, 0)
+        stop = min(int(indices[-1]) + 1 + margin, size)
+        if stop - start < roi:
+            # Grow around the body instead of letting sliding_window_inference pad with zeros
+            start = max(min(start, size - roi), 0)
+            stop = min(start + roi, size)
+        crop.append(slice(start, stop))
+    return tuple(crop)
+
+
+def predict(model, test_inputs, progress_callback=None, cancel_event=None, settings=None, stats=None, threshold=None):
+    # progress_callback(done, total) is called after every batch of windows,
+    # setting cancel_event aborts the pass with InferenceCancelled before the next batch.
+    # With a foreground threshold only the body bounding box is tiled, and windows inside it that
+    # are all air skip the model and are filled with background logits. threshold is computed from
+    # the inputs unless given. stats, if given, receives the window counts.
+    settings = settings or InferenceSettings()
+    inputs = test_inputs.to(device)
+    spatial_shape = inputs.shape[2:]
+
+    crop = None
+    if settings.foreground_threshold > 0:
+        if threshold is None:
+            threshold = foreground_threshold(inputs, settings.foreground_threshold)
+        crop = foreground_crop(inputs, threshold, settings.foreground_margin)
+    else:
+        threshold = None
+    crop = crop or tuple(slice(0, size) for size in spatial_shape)
+    cropped = inputs[(slice(None), slice(None), *crop)]
+    if cropped.dtype != torch.float32:
+        # The network is fp32. Integer volumes, and float64 ones (also what scaled integers
+        # decode to), are cast here, and sliding_window_inference accumulates in the input dtype.
+        cropped = cropped.to(torch.float32)
+
+    total = count_windows(cropped.shape[2:], overlap=settings.overlap) * inputs.shape[0]
+    done = 0
+    inferred = 0
+
+    def predictor(windows):
+        nonlocal done, inferred
+        _check_cancelled(cancel_event)
+        if threshold is None:
+            output = model(windows)
+            inferred += windows.shape[0]
+        else:
+            occupied = (windows > threshold).flatten(1).any(dim=1)
+            output = background_logits((windows.shape[0], *windows.shape[2:]), windows.device)
+            if occupied.any():
+                output[occupied] = model(windows[occupied]).to(output.dtype)
+                inferred += int(occupied.sum())
+        done += windows.shape[0]
+        if progress_callback is not None:
+            progress_callback(done, total)
+        return output
+
+    with torch.no_grad():
+        pred = sliding_window_inference(
+            cropped, patch_size, settings.sw_batch_size, predictor,
+            overlap=settings.overlap, mode=settings.blend_mode,
+        )
+        if tuple(pred.shape[2:]) != tuple(spatial_shape):
+            # Paste back into the full-size map so Invertd sees the reoriented image's geometry
+            full = background_logits((inputs.shape[0], *spatial_shape), pred.device)
+            full[(slice(None), slice(None), *crop)] = pred
+            pred = convert_to_dst_type(full, inputs, dtype=full.dtype, device=full.device)[0]
+
+    if stats is not None:
+        stats.update({
+            "windows": total,
+            "windows_inferred": inferred,
+            "crop_shape": [s.stop - s.start for s in crop],
+        })
+    return pred
+
+
+def predict_labels(model, test_inputs, progress_callback=None, cancel_event=None, settings=None, stats=None):
+    # Low-memory variant of predict: returns a (batch, 1, ...) uint8 label map and, with
+    # settings.save_probabilities, (batch, num_classes, ...) uint8 softmax probabilities (0-255).
+    # The volume is inferred in z-slabs with half a patch of context on each side, so float logits
+    # only ever exist for one slab.
+    settings = settings or InferenceSettings()
+    inputs = test_inputs.to(device)
+    depth = inputs.shape[-1]
+    slab_depth = max(settings.slab_depth, patch_size[-1])
+    halo = patch_size[-1] // 2
+    slabs = [(start, min(start + slab_depth, depth)) for start in range(0, depth, slab_depth)]
+
+    threshold = None
+    if settings.foreground_threshold > 0:
+        threshold = foreground_threshold(inputs, settings.foreground_threshold)  # Same body threshold for every slab
+
+    labels = torch.zeros((inputs.shape[0], 1, *inputs.shape[2:]), dtype=torch.uint8, device=inputs.device)
+    probabilities = None
+    if settings.save_probabilities:
+        probabilities = torch.zeros((inputs.shape[0], num_classes, *inputs.shape[2:]), dtype=torch.uint8, device=inputs.device)
+
+    for index, (start, stop) in enumerate(slabs):
+        low, high = max(start - halo, 0), min(stop + halo, depth)
+        slab_progress = None
+        if progress_callback is not None:
+            # Each slab counts as 1000 steps, its window count is only known once it starts
+            slab_progress = lambda done, total, index=index: progress_callback(index * 1000 + done * 1000 // total, len(slabs) * 1000)
+        slab_stats = {}
+        logits = predict(model, inputs[..., low:high], slab_progress, cancel_event, settings, slab_stats, threshold)
+        core = logits[..., start - low:stop - low]
+        labels[..., start:stop] = core.argmax(dim=1, keepdim=True).to(torch.uint8)
+        if probabilities is not None:
+            probabilities[..., start:stop] = (torch.softmax(core.float(), dim=1) * 255).round().to(torch.uint8)
+        del logits, core
+        if stats is not None:
+            stats["windows"] = stats.get("windows", 0) + slab_stats["windows"]
+            stats["windows_inferred"] = stats.get("windows_inferred", 0) + slab_stats["windows_inferred"]
+    if stats is not None:
+        stats["slabs"] = len(slabs)
+
+    # Carry the reoriented image's metadata so Invertd and SaveImaged work on the label map
+    labels = convert_to_dst_type(labels, inputs, dtype=torch.uint8, device=labels.device)[0]
+    if probabilities is not None:
+        probabilities = convert_to_dst_type(probabilities, inputs, dtype=torch.uint8, device=probabilities.device)[0]
+    return labels, probabilities
+
+
+def run_inference(model, data, settings=None, progress_callback=None, cancel_event=None, stats=None):
+    # Fills data["pred"] (logits, or the uint8 label map in low-memory mode) and data["prob"]
+    settings = settings or InferenceSettings()
+    inputs = data["image"].unsqueeze(0)
+    if settings.low_memory:
+        labels, probabilities = predict_labels(model, inputs, progress_callback, cancel_event, settings, stats)
+        data["pred"] = labels[0]
+        if probabilities is not None:
+            data["prob"] = probabilities[0]
+    else:
+        data["pred"] = predict(model, inputs, progress_callback, cancel_event, settings, stats)[0]
+    return data
+
+
+def background_logits(shape, device):
+    # (batch, num_classes, *spatial) logits that argmax to background
+    logits = torch.zeros((shape[0], num_classes, *shape[1:]), device=device)
+    logits[:, 0] = BACKGROUND_LOGIT
+    return logits
+
+
+def timed_stage(timer, name):
+    # timer.stage(name) of an instrumentation.CaseTimer, nothing without a timer
+    return timer.stage(name) if timer is not None else contextlib.nullcontext()
+
+
+def load_case(nii_path, test_transforms, timer=None):
+    # Runs test_transforms and also returns the volume as decoded, before reorientation.
+    # The reoriented image is a new tensor, so the decoded one is kept without a copy.
+    load, *reorient = test_transforms.transforms
+    with timed_stage(timer, "decode"):
+        data = load({"image": nii_path})
+    volume = data["image"]
+    with timed_stage(timer, "reorient"):
+        for transform in reorient:
+            data = transform(data)
+    return data, volume
+
+
+def apply_post_transforms(post_transforms, data, timer=None):
+    # Same as post_transforms(data), with each transform timed as its own stage
+    if timer is None:
+        return post_transforms(data)
+    for transform in post_transforms.transforms:
+        with timer.stage(POST_TRANSFORM_STAGES.get(type(transform), type(transform).__name__)):
+            data = transform(data)
+    return data
+
+
+def segment_file(nii_path, model, save_path, progress_callback=None, cancel_event=None, settings=None, timer=None, keep_volume=False):
+    # Load, infer, invert, save and measure a single volume, timer: optional instrumentation.CaseTimer.
+    # keep_volume returns the decoded volume for the quality check. For non-RAS input it is a second
+    # full copy of the image, so by default it is dropped right after reorientation.
+    settings = settings or InferenceSettings()
+    test_transforms = get_test_transforms()
+    post_transforms = get_post_transforms(test_transforms, save_path, settings.low_memory, settings.save_probabilities)
+
+    data, volume = load_case(nii_path, test_transforms, timer)
+    if not keep_volume:
+        volume = None
+    _check_cancelled(cancel_event)
+
+    stats = {}
+    start_time = time.time()
+    with timed_stage(timer, "inference"):
+        run_inference(model, data, settings, progress_callback, cancel_event, stats)
+    inference_time = time.time() - start_time
+    _check_cancelled(cancel_event)
+
+    data = apply_post_transforms(post_transforms, data, timer)
+    mask_path = predicted_mask_path(save_path, nii_path)
+    with timed_stage(timer, "volumetrics"):
+        metrics = compute_volumetrics(data["pred"], label_spacing(data))
+        save_metrics(metrics, metrics_path(mask_path))
+    if timer is not None:
+        timer.counts.update(windows=stats["windows"], windows_inferred=stats["windows_inferred"])
+    return {
+        "nii_path": nii_path,
+        "mask_path": mask_path,
+        "metrics_path": metrics_path(mask_path),
+        "vat_volume": metrics["vat_cm3"],
+        "sat_volume": metrics["sat_cm3"],
+        "vat_sat_ratio": metrics["vat_sat_ratio"],
+        "metrics": metrics,
+        "inference_time": inference_time,
+        # Decoded volume (file orientation, native dtype, None unless keep_volume) and uint8 mask for the in-process quality check
+        "volume": volume.cpu().numpy() if volume is not None else None,
+        "mask": data["pred"][0].to(torch.uint8).cpu().numpy(),
+    }
+
+
+def label_histogram(pred_data, chunk_rows=64):
+    # Voxel counts per (slice, label) in one pass: a (depth, num_classes) int64 tensor.
+    # Slices are along the last axis. Works on the device the labels live on, rows are
+    # processed in chunks to bound the size of the int64 index tensor.
+    labels = torch.as_tensor(pred_data)
+    labels = labels.reshape(-1, *labels.shape[-2:]) if labels.ndim > 2 else labels.reshape(1, *labels.shape)
+    depth = labels.shape[-1]
+    offsets = torch.arange(depth, device=labels.device) * num_classes
+    counts = torch.zeros(depth * num_classes, dtype=torch.int64, device=labels.device)
+    for start in range(0, labels.shape[0], chunk_rows):
+        chunk = labels[start:start + chunk_rows].long().clamp(0, num_classes - 1)
+        counts += torch.bincount((chunk + offsets).reshape(-1), minlength=depth * num_classes)
+    return counts.reshape(depth, num_classes)
+
+
+def _slice_distribution(areas):
+    # Where along z a compartment sits: peak slice, area-weighted centroid and the 5-95% extent
+    total = sum(areas)
+    if total == 0:
+        return {"peak_slice": None, "centroid_slice": None, "slice_range_5_95": None}
+    cumulative = np.cumsum(areas) / total
+    return {
+        "peak_slice": int(np.argmax(areas)),
+        "centroid_slice": round(float(np.dot(np.arange(len(areas)), areas) / total), 2),
+        "slice_range_5_95": [int(np.searchsorted(cumulative, 0.05)), int(np.searchsorted(cumulative, 0.95))],
+    }
+
+
+def compute_volumetrics(pred_data, pixdim):
+    # Totals in cm³, per-slice areas in cm² and the z-distribution of VAT and SAT.
+    # pixdim is the (x, y, z) voxel spacing in mm.
+    pixdim = [float(p) for p in pixdim]
+    counts = label_histogram(pred_data).cpu().numpy()  # Only the (depth, num_classes) table leaves the device
+    voxel_area = pixdim[0] * pixdim[1] / 100  ## mm2 to cm2
+    voxel_volume = pixdim[0] * pixdim[1] * pixdim[2] / 1000  ## mm3 to cm3
+    vat_counts = counts[:, VAT_LABEL]
+    sat_counts = counts[:, SAT_LABEL]
+    vat_volume = round(float(vat_counts.sum()) * voxel_volume, 4)
+    sat_volume = round(float(sat_counts.sum()) * voxel_volume, 4)
+    vat_areas = [round(float(c) * voxel_area, 3) for c in vat_counts]
+    sat_areas = [round(float(c) * voxel_area, 3) for c in sat_counts]
+    return {
+        "vat_cm3": vat_volume,
+        "sat_cm3": sat_volume,
+        "vat_sat_ratio": round(vat_volume / sat_volume, 4) if sat_volume else None,
+        "spacing_mm": pixdim,
+        "vat_area_cm2": vat_areas,
+        "sat_area_cm2": sat_areas,
+        "vat_distribution": _slice_distribution(vat_areas),
+        "sat_distribution": _slice_distribution(sat_areas),
+    }
+
+
+def label_spacing(data):
+    # Voxel spacing (mm) of the inverted label map, in the axis order of the input file.
+    # The image's meta["pixdim"] is in the reoriented (RAS) order and only matches for RAS input.
+    return [float(s) for s in data["pred"].pixdim]
+
+
+def compute_volumes(pred_data, pixdim):
+    # Returns (vat, sat) in cm³
+    metrics = compute_volumetrics(pred_data, pixdim)
+    return metrics["vat_cm3"], metrics["sat_cm3"]
+
+
+def predicted_prob_path(save_path, nii_path):
+    # Written next to the mask when low-memory mode saves probabilities
+    return f"{save_path}/{os.path.basename(nii_path).split('.')[0]}_prob.nii"
+
+
+def metrics_path(mask_path):
+    return os.path.splitext(mask_path)[0] + "_metrics.json"
+
+
+def save_metrics(metrics, path):
+    # Compact sidecar next to the mask so downstream analyses don't need to reload it
+    with open(path, "w") as file:
+        json.dump(metrics, file, separators=(",", ":"))
+
+
+def predicted_mask_path(save_path, nii_path):
+    # Mirrors the file name SaveImaged produces for output_postfix="pred"
+    return f"{save_path}/{os.path.basename(nii_path).split('.')[0]}_pred.nii"
+
+
+def format_inference_time(inference_time):
+    if inference_time < 60:
+        sec = int(inference_time)
+        msec = (inference_time % 1) * 1000
+        return f"{sec} seconds:{msec:.2f} milliseconds"
+    else:
+        min = int(inference_time / 60)
+        sec = round(inference_time % 60)  # Round the seconds part to the nearest whole number
+        return f"{min} minutes,{sec} seconds"
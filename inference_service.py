@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import dataclasses
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+
+import inference
+import result_cache
+import instrumentation
+
+# Long-running local segmentation service that keeps the model warm.
+#
+# Requests go into a FIFO queue served by a few job threads. Each job runs the normal
+# segment_file pipeline, but the model is replaced by a PatchBatcher shared by all jobs:
+# window batches from volumes in flight are concatenated into one forward pass of up to
+# sw_batch_size windows, so the network stays busy while the other jobs decode, invert or save.
+#
+#   python inference_service.py --model model.pth
+#   curl -X POST http://127.0.0.1:8765/segment -d '{"input": "/data/case.nii.gz", "output": "/data/masks"}'
+#   curl http://127.0.0.1:8765/health
+#
+# Only binds to localhost by default, input and output are paths on this machine. Responses include
+# the per-stage timings, FATVIT_STAGE_LOG / FATVIT_PROMETHEUS_TEXTFILE also export them (see instrumentation.py).
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class PatchBatcher:
+    # Callable stand-in for the model. Window batches submitted from concurrent sliding-window
+    # passes are collected for up to max_wait seconds, until max_batch windows are pending, and
+    # run through the model together. A batch that would not fit is held back for the next pass,
+    # so no forward pass runs more than max_batch windows.
+    def __init__(self, model, max_batch, max_wait=0.005):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.held = None  # Request that did not fit into the previous pass
+        self.forward_passes = 0
+        self.windows = 0
+        self.largest_pass = 0  # Most windows in one forward pass, never above max_batch
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, windows):
+        request = {"windows": windows, "done": threading.Event(), "output": None, "error": None}
+        self.requests.put(request)
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["output"]
+
+    def _run(self):
+        while True:
+            if self.held is not None:
+                pending, self.held = [self.held], None
+            else:
+                pending = [self.requests.get()]
+            count = pending[0]["windows"].shape[0]
+            deadline = time.perf_counter() + self.max_wait
+            while count < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if count + request["windows"].shape[0] > self.max_batch:
+                    self.held = request
+                    break
+                pending.append(request)
+                count += request["windows"].shape[0]
+            self._forward(pending)
+
+    def _forward(self, pending):
+        try:
+            windows = torch.cat([request["windows"] for request in pending])
+            outputs = []
+            with torch.no_grad():  # Grad mode is per thread, the callers' no_grad does not apply here
+                # Only a single request larger than max_batch is split, everything else is one pass
+                for chunk in windows.split(self.max_batch):
+                    outputs.append(self.model(chunk))
+                    self.forward_passes += 1
+                    self.largest_pass = max(self.largest_pass, chunk.shape[0])
+            output = torch.cat(outputs) if len(outputs) > 1 else outputs[0]
+            start = 0
+            for request in pending:
+                count = request["windows"].shape[0]
+                request["output"] = output[start:start + count]
+                start += count
+            self.windows += windows.shape[0]
+        except Exception as e:
+            for request in pending:
+                request["error"] = e
+        finally:
+            for request in pending:
+                request["done"].set()
+
+
+class SegmentationService:
+    def __init__(self, model_path, settings=None, max_jobs=2, instruments=None):
+        self.model_path = os.path.abspath(model_path)
+        self.settings = settings or inference.InferenceSettings()
+        self.instruments = instruments
+        inference.apply_settings(self.settings)
+        load_start = time.perf_counter()
+        model = inference.get_model(model_path, precision=self.settings.precision)
+        self.load_time = time.perf_counter() - load_start
+        self.batcher = PatchBatcher(model, self.settings.sw_batch_size)
+
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        for _ in range(max_jobs):
+            threading.Thread(target=self._job_loop, daemon=True).start()
+
+    def submit(self, nii_path, save_path):
+        # Queues a volume and blocks until it is done, returns the result or raises its error
+        job = {"nii_path": nii_path, "save_path": save_path, "queued": time.perf_counter(),
+               "done": threading.Event(), "result": None, "error": None}
+        self.jobs.put(job)
+        job["done"].wait()
+        if job["error"] is not None:
+            raise job["error"]
+        return job["result"]
+
+    def _job_loop(self):
+        while True:
+            job = self.jobs.get()
+            start_time = time.perf_counter()
+            with self.lock:
+                self.running += 1
+            try:
+                job["result"] = self._segment(job["nii_path"], job["save_path"])
+                job["result"]["queue_seconds"] = start_time - job["queued"]
+                job["result"]["total_seconds"] = time.perf_counter() - job["queued"]
+            except Exception as e:
+                job["error"] = e
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += job["error"] is None
+                    self.failed += job["error"] is not None
+                job["done"].set()
+
+    def _segment(self, nii_path, save_path):
+        if self.instruments is not None:
+            timer = self.instruments.case(nii_path)
+        else:
+            timer = instrumentation.CaseTimer(nii_path)
+        result = result_cache.segment_file(nii_path, self.model_path, save_path, settings=self.settings, model=self.batcher, timer=timer)
+        if self.instruments is not None:
+            self.instruments.emit(timer.record())
+        # Decoded arrays stay in the service, the client reads the saved files
+        result = {k: v for k, v in result.items() if k not in ("volume", "mask")}
+        result["stages"] = timer.stages
+        return result
+
+    def status(self):
+        with self.lock:
+            return {
+                "status": "ok",
+                "model": self.model_path,
+                "device": str(inference.device),
+                "settings": dataclasses.asdict(self.settings),
+                "model_load_seconds": self.load_time,
+                "queued": self.jobs.qsize(),
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "forward_passes": self.batcher.forward_passes,
+                "windows": self.batcher.windows,
+                "largest_pass": self.batcher.largest_pass,
+            }
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    service = None  # Set by serve
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, self.service.status())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/segment":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            nii_path, save_path = request["input"], request["output"]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": "Expected a JSON body with 'input' and 'output' paths"})
+            return
+        if not os.path.isfile(nii_path):
+            self.send_json(400, {"error": f"Input volume {nii_path} does not exist"})
+            return
+        if request.get("model") and os.path.abspath(request["model"]) != self.service.model_path:
+            self.send_json(409, {"error": f"Service is running {self.service.model_path}, not {request['model']}"})
+            return
+        try:
+            result = self.service.submit(nii_path, save_path)
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} {format % args}")
+
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    handler = type("BoundServiceHandler", (ServiceHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="FatViT local segmentation service with a warm model")
+    parser.add_argument("--model", required=True, help="Trained model (.pth, .pt or .onnx)")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Interface to bind (default: localhost only)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--jobs", type=int, default=2, help="Volumes in flight at once, their windows share forward passes")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = inference.load_settings()
+    service = SegmentationService(args.model, settings, max(1, args.jobs), instrumentation.from_environment())
+    server = serve(service, args.host, args.port)
+    print(f"Serving {args.model} on http://{args.host}:{server.server_port} ({inference.device}, "
+          f"model loaded in {inference.format_inference_time(service.load_time)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+import torch
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import psutil  # Optional, only used where /proc/self/statm is not available
+except ImportError:
+    psutil = None
+
+# Per-stage timing and resource use of each segmented case.
+#
+# A CaseTimer is handed through the pipeline (result_cache / inference.segment_file, batch_segment's
+# stages) and every step runs inside `with timer.stage(name)`:
+#   cache_lookup, model_load, decode, reorient, inference, invert, argmax, save, volumetrics
+# Each stage records wall time, CPU time and the peak RSS sampled while it ran (plus peak GPU memory
+# on CUDA). The case's peak RSS is the largest of its stages.
+# The finished record also holds the window counts from inference.predict. Instrumentation writes
+# records as JSON lines and, optionally, a Prometheus node_exporter textfile with running totals.
+#
+# CPU time and memory are per process: when stages overlap (batch_segment's pipeline, the service)
+# they include the other stages running at the same time.
+#
+# Configured by command-line flags or, for the GUI and the service, by environment variables:
+#   FATVIT_STAGE_LOG            JSON lines file, one record per case
+#   FATVIT_PROMETHEUS_TEXTFILE  Prometheus textfile, rewritten after every case
+#   FATVIT_PROFILE_DIR          torch.profiler Chrome trace of each case's inference stage
+
+STAGE_LOG_PATH = os.environ.get("FATVIT_STAGE_LOG", "")
+PROMETHEUS_PATH = os.environ.get("FATVIT_PROMETHEUS_TEXTFILE", "")
+PROFILE_DIR = os.environ.get("FATVIT_PROFILE_DIR", "")
+
+PROFILED_STAGES = ("inference",)  # Traced with torch.profiler when a profile directory is set
+RSS_SAMPLE_INTERVAL = 0.01  # Seconds between RSS samples while a stage runs
+
+
+def process_peak_rss_mb():
+    # High-water mark over the whole process lifetime, not of any single stage or case.
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def current_rss_mb():
+    # Resident memory right now, None where it can't be read
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    return None
+
+
+class RssMonitor:
+    # Peak RSS while a block runs, sampled on a background thread. Unlike ru_maxrss this is not
+    # carried over from earlier work in the process. Allocations that come and go between two
+    # samples are missed. peak_mb is None where RSS can't be read.
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        if self.peak_mb is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return False
+
+
+def max_known(*values):
+    # Largest of the values that are not None, None if there are none
+    return max((value for value in values if value is not None), default=None)
+
+
+class CaseTimer:
+    def __init__(self, case, profile_dir=None):
+        self.case = case
+        self.profile_dir = profile_dir
+        self.started = time.time()
+        self.stages = {}
+        self.counts = {}  # Window counts and flags, merged into the record
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        cuda = torch.cuda.is_available()
+        if cuda:
+            torch.cuda.reset_peak_memory_stats()
+        profiler = self._profiler(name)
+        memory = RssMonitor()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            with memory, profiler:
+                yield
+        finally:
+            # Repeated stages (e.g. one save per output key) add up
+            entry = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": None})
+            entry["wall_seconds"] += time.perf_counter() - wall
+            entry["cpu_seconds"] += time.process_time() - cpu
+            entry["peak_rss_mb"] = max_known(entry["peak_rss_mb"], memory.peak_mb)
+            if cuda:
+                entry["peak_gpu_mb"] = torch.cuda.max_memory_allocated() / 2**20
+            if not isinstance(profiler, contextlib.nullcontext):
+                self._export_trace(profiler, name)
+
+    def _export_trace(self, profiler, name):
+        # Like Instrumentation.emit, a trace that can't be written does not fail the case
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            stem = os.path.basename(str(self.case)).split(".")[0]
+            profiler.export_chrome_trace(os.path.join(self.profile_dir, f"{stem}_{name}.json"))
+        except Exception as e:
+            print(f"Could not write the {name} trace of {self.case}: {e}")
+
+    def _profiler(self, name):
+        if not self.profile_dir or name not in PROFILED_STAGES:
+            return contextlib.nullcontext()
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        return torch.profiler.profile(activities=activities)
+
+    def record(self):
+        return {
+            "case": self.case,
+            "timestamp": self.started,
+            "total_wall_seconds": sum(stage["wall_seconds"] for stage in self.stages.values()),
+            "total_cpu_seconds": sum(stage["cpu_seconds"] for stage in self.stages.values()),
+            "peak_rss_mb": max_known(*(stage["peak_rss_mb"] for stage in self.stages.values())),
+            **self.counts,
+            "stages": self.stages,
+        }
+
+
+class Instrumentation:
+    # Collects finished case records and writes them out, safe to share between threads
+    def __init__(self, stage_log=None, prometheus_path=None, profile_dir=None):
+        self.stage_log = stage_log
+        self.prometheus_path = prometheus_path
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.cases = 0
+        self.windows = 0
+        self.windows_inferred = 0
+        self.totals = {}  # {stage: [wall_seconds, cpu_seconds, runs]}
+        self.last = {}  # {stage: wall_seconds} of the latest case
+
+    def case(self, case):
+        return CaseTimer(case, self.profile_dir)
+
+    def emit(self, record):
+        # record: CaseTimer.record(), also accepted from worker processes.
+        # Never raises: a stage log or textfile that can't be written is reported and the case goes on.
+        with self.lock:
+            try:
+                self._emit(record)
+            except Exception as e:
+                print(f"Could not write instrumentation for {record.get('case')}: {e}")
+
+    def _emit(self, record):
+        if record.get("case") is not None:
+            self.cases += 1
+        self.windows += record.get("windows", 0)
+        self.windows_inferred += record.get("windows_inferred", 0)
+        for name, stage in record["stages"].items():
+            total = self.totals.setdefault(name, [0.0, 0.0, 0])
+            total[0] += stage["wall_seconds"]
+            total[1] += stage["cpu_seconds"]
+            total[2] += 1
+            self.last[name] = stage["wall_seconds"]
+        if self.stage_log:
+            os.makedirs(os.path.dirname(os.path.abspath(self.stage_log)), exist_ok=True)
+            with open(self.stage_log, "a") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+        if self.prometheus_path:
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        lines = [
+            "# HELP fatvit_stage_wall_seconds_total Wall time spent in each pipeline stage.",
+            "# TYPE fatvit_stage_wall_seconds_total counter",
+            *(f'fatvit_stage_wall_seconds_total{{stage="{name}"}} {total[0]:.6f}' for name, total in sorted(self.totals.items())),
+            "# HELP fatvit_stage_cpu_seconds_total Process CPU time spent in each pipeline stage.",
+            "# TYPE fatvit_stage_cpu_seconds_total counter",
+            *(f'fatvit_stage_cpu_seconds_total{{stage="{name}"}} {total[1]:.6f}' for name, total in sorted(self.totals.items())),
+            "# HELP fatvit_stage_runs_total Number of times each pipeline stage ran.",
+            "# TYPE fatvit_stage_runs_total counter",
+            *(f'fatvit_stage_runs_total{{stage="{name}"}} {total[2]}' for name, total in sorted(self.totals.items())),
+            "# HELP fatvit_last_stage_wall_seconds Wall time of each stage for the latest case.",
+            "# TYPE fatvit_last_stage_wall_seconds gauge",
+            *(f'fatvit_last_stage_wall_seconds{{stage="{name}"}} {seconds:.6f}' for name, seconds in sorted(self.last.items())),
+            "# HELP fatvit_cases_total Cases segmented.",
+            "# TYPE fatvit_cases_total counter",
+            f"fatvit_cases_total {self.cases}",
+            "# HELP fatvit_windows_total Sliding windows, including the ones skipped as background.",
+            "# TYPE fatvit_windows_total counter",
+            f"fatvit_windows_total {self.windows}",
+            "# HELP fatvit_windows_inferred_total Sliding windows run through the model.",
+            "# TYPE fatvit_windows_inferred_total counter",
+            f"fatvit_windows_inferred_total {self.windows_inferred}",
+            "# HELP fatvit_process_peak_rss_bytes Peak resident memory over the process lifetime.",
+            "# TYPE fatvit_process_peak_rss_bytes gauge",
+            f"fatvit_process_peak_rss_bytes {int(process_peak_rss_mb() * 2**20)}",
+        ]
+        # node_exporter may read the file at any time, so it is replaced in one step
+        tmp_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prometheus_path)
+
+
+def from_environment(stage_log=None, prometheus_path=None, profile_dir=None):
+    # Arguments override the environment variables, None if nothing is configured
+    stage_log = stage_log or STAGE_LOG_PATH
+    prometheus_path = prometheus_path or PROMETHEUS_PATH
+    profile_dir = profile_dir or PROFILE_DIR
+    if not (stage_log or prometheus_path or profile_dir):
+        return None
+    return Instrumentation(stage_log, prometheus_path, profile_dir)
@@ -1,20 +1,88 @@
 import sys
-import torch
-import time
-import nibabel as nib
-import subprocess
+import threading
 
-from PyQt6.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QWidget, QVBoxLayout, QHBoxLayout, QGroupBox, QFileDialog
-from PyQt6.QtGui import QIcon
-from PyQt6.QtCore import Qt
+from PyQt6.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QWidget, QVBoxLayout, QHBoxLayout, QGroupBox, QFileDialog, QProgressBar
+from PyQt6.QtGui import QIcon, QMovie
+from PyQt6.QtCore import Qt, QThread, QTimer, pyqtSignal
 
-from monai.data import DataLoader, Dataset, decollate_batch
-from monai.transforms import Compose, LoadImaged, SaveImaged, EnsureChannelFirstd, Orientationd, Invertd, AsDiscreted
-from monai.networks.nets import SwinUNETR
-from monai.inferers import sliding_window_inference
+import service_client
 
+# torch, MONAI, nibabel and matplotlib take seconds to import, so they are loaded by ModuleLoader
+# once the window is up. The buttons that need them are enabled when it finishes.
+nib = None
+inference = None
+quality_check = None
+result_cache = None
+instrumentation = None
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def load_modules():
+    global nib, inference, quality_check, result_cache, instrumentation
+    import nibabel as nib
+    import inference
+    import result_cache
+    import instrumentation
+    import quality_check
+    quality_check.load_matplotlib()  # So the first quality check opens without the import delay
+
+class ModuleLoader(QThread):
+    loaded = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def run(self):
+        try:
+            load_modules()
+            self.loaded.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class PredictionWorker(QThread):
+    # Runs one segmentation job off the GUI thread
+    progress = pyqtSignal(int, int)  # windows done, windows total
+    succeeded = pyqtSignal(dict)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, nii_path, model_path, save_path, settings, instruments=None):
+        super().__init__()
+        self.nii_path = nii_path
+        self.model_path = model_path
+        self.save_path = save_path
+        self.settings = settings
+        self.instruments = instruments  # Stage timings are only recorded when configured, see instrumentation.py
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            if service_client.SERVICE_URL:
+                # Thin client: the service holds the model, no progress and the job can't be stopped once sent
+                result = service_client.segment(self.nii_path, self.save_path, self.model_path)
+                if self.cancel_event.is_set():
+                    self.cancelled.emit()
+                    return
+                result.update(volume=None, mask=None)  # The quality check reads the saved files
+                self.succeeded.emit(result)
+                return
+            inference.apply_settings(self.settings)
+            timer = self.instruments.case(self.nii_path) if self.instruments is not None else None
+            result = result_cache.segment_file(
+                self.nii_path, self.model_path, self.save_path,
+                progress_callback=self.progress.emit,
+                cancel_event=self.cancel_event,
+                settings=self.settings,
+                timer=timer,
+                keep_volume=True,  # Shown by the quality check
+            )
+            if timer is not None:
+                self.instruments.emit(timer.record())
+            self.succeeded.emit(result)
+        except inference.InferenceCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -35,6 +103,10 @@ class MainWindow(QMainWindow):
         self.btnAutomatedSeg = QPushButton("Automated segmentation")
         self.btnAutomatedSeg.clicked.connect(self.make_prediction)
         
+        # Need the deferred modules, enabled by on_modules_loaded
+        for button in (self.btnLoadVolume, self.btnLoadModel, self.btnAutomatedSeg):
+            button.setEnabled(False)
+        
         self.btnSaveSeg = QPushButton("Select save folder")
         self.btnSaveSeg.clicked.connect(self.show_dialog_save_dir)
         
@@ -42,16 +114,35 @@ class MainWindow(QMainWindow):
         self.btnQualityCheck.setEnabled(False)  # Initially disabled
         self.btnQualityCheck.clicked.connect(self.launch_quality_check)
         
+        self.btnCancel = QPushButton("Cancel")
+        self.btnCancel.setEnabled(False)  # Enabled while a segmentation is running
+        self.btnCancel.clicked.connect(self.cancel_prediction)
+        
         buttonLayout.addWidget(self.btnLoadVolume)
         buttonLayout.addWidget(self.btnLoadModel)
         buttonLayout.addWidget(self.btnSaveSeg)
         buttonLayout.addWidget(self.btnAutomatedSeg)
         buttonLayout.addWidget(self.btnQualityCheck)
+        buttonLayout.addWidget(self.btnCancel)
 
         # Model Path Label
-        self.lblModelPath = QLabel("No model selected")
+        self.lblModelPath = QLabel("Loading segmentation libraries...")
         self.lblModelPath.setAlignment(Qt.AlignmentFlag.AlignCenter)
 
+        # Progress of the running job
+        progressLayout = QHBoxLayout()
+        self.lblSpinner = QLabel()
+        self.spinner = QMovie("assets/gif/icons8-spinner.gif")
+        self.lblSpinner.setMovie(self.spinner)
+        self.lblSpinner.setVisible(False)
+        self.progressBar = QProgressBar()
+        self.progressBar.setRange(0, 1)
+        self.progressBar.setValue(0)
+        self.lblQueue = QLabel("")
+        progressLayout.addWidget(self.lblSpinner)
+        progressLayout.addWidget(self.progressBar)
+        progressLayout.addWidget(self.lblQueue)
+
         # Results
         volumeLayout = QHBoxLayout()
         resultGroup = QGroupBox("Abdominal Fat Quantification")
@@ -72,12 +163,49 @@ class MainWindow(QMainWindow):
 
         mainLayout.addLayout(buttonLayout)
         mainLayout.addWidget(self.lblModelPath)
+        mainLayout.addLayout(progressLayout)
         mainLayout.addLayout(volumeLayout)
         
         centralWidget = QWidget()
         centralWidget.setLayout(mainLayout)
         self.setCentralWidget(centralWidget)
         
+        self.pending_jobs = []  # (nii_path, model_path, save_path) waiting for the worker
+        self.worker = None
+        self.settings = None
+        self.instruments = None
+        
+        # Busy indicator while the modules load, started once the event loop runs so the window paints first
+        self.progressBar.setRange(0, 0)
+        self.lblSpinner.setVisible(True)
+        self.spinner.start()
+        self.loader = ModuleLoader()
+        self.loader.loaded.connect(self.on_modules_loaded)
+        self.loader.failed.connect(self.on_modules_failed)
+        QTimer.singleShot(0, self.loader.start)
+        
+    def on_modules_loaded(self):
+        try:
+            self.settings = inference.load_settings()
+        except Exception as e:
+            print(f"Error reading {inference.SETTINGS_PATH}, using defaults: {e}")
+            self.settings = inference.InferenceSettings()
+        self.instruments = instrumentation.from_environment()
+        
+        self.progressBar.setRange(0, 1)
+        self.lblSpinner.setVisible(False)
+        self.spinner.stop()
+        self.lblModelPath.setText("No model selected")
+        for button in (self.btnLoadVolume, self.btnLoadModel, self.btnAutomatedSeg):
+            button.setEnabled(True)
+    
+    def on_modules_failed(self, message):
+        print(f"Error loading segmentation libraries: {message}")
+        self.progressBar.setRange(0, 1)
+        self.lblSpinner.setVisible(False)
+        self.spinner.stop()
+        self.lblModelPath.setText(f"Error loading segmentation libraries: {message}")
+        
     # def showEvent(self, event):
     #     super().showEvent(event)
     #     print(f"Window size: {self.size().width()} x {self.size().height()}")
@@ -94,104 +222,106 @@ class MainWindow(QMainWindow):
             self.save_path = save_path
 
     def show_dialog_model_predict(self):
-        self.dl_model_path, _ = QFileDialog.getOpenFileName(self, "Open trained DL model", "", "PyTorch model (*.pth)")
+        self.dl_model_path, _ = QFileDialog.getOpenFileName(self, "Open trained DL model", "", "Trained model (*.pth *.pt *.ts *.onnx)")
         if self.dl_model_path:
             self.lblModelPath.setText(f"{self.inference_time_str if hasattr(self, 'inference_time_str') else ''}")
+            if not service_client.SERVICE_URL:  # The service keeps its own model warm
+                inference.warm_up_model(self.dl_model_path, precision=self.settings.precision)  # Start loading while the user picks the volume
               
     def load_nii(self, nii_path):
+        # Header only, nibabel loads the voxel data lazily and the volume is decoded once by the inference transforms
         self.nii_obj = nib.load(self.nii_path)
-        self.nii_data = self.nii_obj.get_fdata()
             
-    def format_inference_time(self, inference_time):
-        if inference_time < 60:
-            sec = int(inference_time)
-            msec = (inference_time % 1) * 1000
-            return f"{sec} seconds:{msec:.2f} milliseconds" 
-        else:
-            min = int(inference_time / 60)
-            sec = round(inference_time % 60)  # Round the seconds part to the nearest whole number
-            return f"{min} minutes,{sec} seconds"
-
     def make_prediction(self):
+        # Queues the selected volume, it starts right away if nothing is running
+        if not all(hasattr(self, attr) and getattr(self, attr) for attr in ("nii_path", "dl_model_path", "save_path")):
+            print("Select a volume, a model and a save folder first")
+            return
+        self.pending_jobs.append((self.nii_path, self.dl_model_path, self.save_path))
+        print([self.nii_path])
+        if self.worker is None:
+            self.start_next_job()
+        self.update_queue_label()
+    
+    def start_next_job(self):
+        if not self.pending_jobs:
+            self.btnCancel.setEnabled(False)
+            self.lblSpinner.setVisible(False)
+            self.spinner.stop()
+            return
+        nii_path, model_path, save_path = self.pending_jobs.pop(0)
+        self.worker = PredictionWorker(nii_path, model_path, save_path, self.settings, self.instruments)
+        self.worker.progress.connect(self.show_progress)
+        self.worker.succeeded.connect(self.show_prediction)
+        self.worker.failed.connect(self.show_prediction_error)
+        self.worker.cancelled.connect(self.show_prediction_cancelled)
+        self.worker.finished.connect(self.on_worker_finished)
+        
+        self.progressBar.setRange(0, 0)  # Busy until the first window reports back
+        self.lblModelPath.setText(f"Segmenting {nii_path.split('/')[-1]}")
+        self.lblSpinner.setVisible(True)
+        self.spinner.start()
+        self.btnCancel.setEnabled(True)
+        self.worker.start()
+        self.update_queue_label()
+    
+    def on_worker_finished(self):
+        self.worker.deleteLater()
+        self.worker = None
+        self.start_next_job()
+    
+    def cancel_prediction(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.btnCancel.setEnabled(False)
+            self.lblModelPath.setText("Cancelling...")
+    
+    def update_queue_label(self):
+        self.lblQueue.setText(f"Queued: {len(self.pending_jobs)}" if self.pending_jobs else "")
+    
+    def show_progress(self, done, total):
+        self.progressBar.setRange(0, total)
+        self.progressBar.setValue(done)
+    
+    def show_prediction(self, result):
         try:
-            test_files = [self.nii_path]
-            print(test_files)
-        
-            test_transforms = Compose([
-                LoadImaged(keys=["image"]),
-                EnsureChannelFirstd(keys=["image"]),
-                Orientationd(keys=["image"], axcodes="RAS"),
-            ])
-
-            test_files = [{"image": file} for file in test_files]
-
-            test_ds = Dataset(data=test_files, transform=test_transforms)
-            test_loader = DataLoader(test_ds, batch_size=1, num_workers=1)
-            post_transforms = Compose([
-                Invertd(
-                    keys="pred",
-                    transform=test_transforms,
-                    orig_keys="image",
-                    meta_keys="pred_meta_dict",
-                    orig_meta_keys="image_meta_dict",
-                    meta_key_postfix="meta_dict",
-                    nearest_interp=False,
-                    to_tensor=True,
-                    device=device,
-                ),
-                AsDiscreted(keys="pred", argmax=True),
-                SaveImaged(keys="pred", meta_keys="pred_meta_dict", output_dir=self.save_path, output_ext=".nii", output_postfix="pred", separate_folder=False, resample=False),
-            ])
-        
-            num_classes = 3
-            patch_size = (64, 64, 32)
-
-            self.model = SwinUNETR(
-                img_size=patch_size, 
-                in_channels=1,
-                out_channels=num_classes,
-                feature_size=48,
-                spatial_dims=3
-            )
-            state_dict = torch.load(self.dl_model_path, map_location=device)  # Use the device variable here
-            new_state_dict = {k.replace('module.', ''): v for k, v in state_dict.items()}
-
-            self.model.load_state_dict(new_state_dict)
-            self.model = self.model.to(device)  # Use the device variable here
-        
-            self.model.eval()
-
-            with torch.no_grad():
-                for test_data in test_loader:
-                    test_inputs = test_data["image"].to(device)  # Use the device variable here
-                    sw_batch_size = 4
-                
-                    start_time = time.time()
-                    test_data["pred"] = sliding_window_inference(test_inputs, patch_size, sw_batch_size, self.model)
-                    inference_time = time.time() - start_time
-                    test_data = [post_transforms(i) for i in decollate_batch(test_data)]
-                
-                    self.inference_time_str = self.format_inference_time(inference_time)
-                    print(f"Inference time: {self.inference_time_str}")
-                    
-                    # Calculate SAT and VAT volumes
-                    pred_data = test_data[0]["pred"].cpu().numpy()
-                    sat_volume = round(((pred_data == 2).sum() * self.nii_obj.header["pixdim"][1:4].prod()) / 1000, 4)  ## mm3 to cm3
-                    vat_volume = round(((pred_data == 1).sum() * self.nii_obj.header["pixdim"][1:4].prod()) / 1000, 4)
-                    self.lblSAT.setText(f"SAT (cm³)\n{sat_volume:.2f}")
-                    self.lblVAT.setText(f"VAT (cm³)\n{vat_volume:.2f}")
-                    self.lblVATtoSAT.setText(f"VAT/SAT (cm³)\n{vat_volume/sat_volume:.2f}")
-                    
-                    self.lblModelPath.setText(f"Inference time: {self.inference_time_str}")
-                    self.predicted_mask_path = f"{self.save_path}/{self.nii_path.split('/')[-1].split('.')[0]}_pred.nii"  # Save path for predicted mask
-                    self.btnQualityCheck.setEnabled(True)  # Enable the Quality Check button
-                    
+            self.inference_time_str = inference.format_inference_time(result["inference_time"])
+            print(f"Inference time: {self.inference_time_str}")
+            
+            vat_volume, sat_volume, ratio = result["vat_volume"], result["sat_volume"], result["vat_sat_ratio"]
+            self.lblSAT.setText(f"SAT (cm³)\n{sat_volume:.2f}")
+            self.lblVAT.setText(f"VAT (cm³)\n{vat_volume:.2f}")
+            self.lblVATtoSAT.setText(f"VAT/SAT (cm³)\n{ratio:.2f}" if ratio is not None else "VAT/SAT (cm³)\nn/a")
+            
+            self.lblModelPath.setText(f"Inference time: {self.inference_time_str}{' (cached result)' if result['cached'] else ''}")
+            self.predicted_nii_path = result["nii_path"]  # Volume the mask belongs to, nii_path may already point at the next one
+            self.predicted_mask_path = result["mask_path"]  # Save path for predicted mask
+            # Decoded arrays handed to the quality check, only the latest case is kept
+            self.predicted_volume = result["volume"]
+            self.predicted_mask = result["mask"]
+            self.btnQualityCheck.setEnabled(True)  # Enable the Quality Check button
         except Exception as e:
             print(f"Error during prediction: {e}")
     
+    def show_prediction_error(self, message):
+        print(f"Error during prediction: {message}")
+        self.lblModelPath.setText(f"Error during prediction: {message}")
+        self.progressBar.setRange(0, 1)
+        self.progressBar.setValue(0)
+    
+    def show_prediction_cancelled(self):
+        self.lblModelPath.setText("Segmentation cancelled")
+        self.progressBar.setRange(0, 1)
+        self.progressBar.setValue(0)
+    
     def launch_quality_check(self):
-        if hasattr(self, 'nii_path') and hasattr(self, 'predicted_mask_path'):
-            subprocess.Popen([sys.executable, "quality_check.py", self.nii_path, self.predicted_mask_path])
+        if hasattr(self, 'predicted_nii_path') and hasattr(self, 'predicted_mask_path'):
+            # Opens in this process and reuses the arrays from the segmentation, nothing is re-read from disk
+            self.qc_window = quality_check.MainWindow(
+                self.predicted_nii_path, self.predicted_mask_path,
+                volume=self.predicted_volume, mask=self.predicted_mask,
+            )
+            self.qc_window.show()
 
 if __name__ == "__main__":
     try:
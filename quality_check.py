@@ -1,17 +1,140 @@
 import sys
 import os
-# import numpy as np
+import numpy as np
 import nibabel as nib
 import csv
+import gzip
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget, QSpinBox, QRadioButton, QButtonGroup, QGroupBox, QHBoxLayout, QPushButton, QFrame
+from PyQt6.QtCore import Qt
+from PyQt6.QtGui import QIcon, QKeySequence, QShortcut
+
+NUM_LABELS = 3  # Background, VAT, SAT
+OVERLAY_ALPHA = 0.7
+PREFETCH_SLICES = 3  # Neighbours decoded ahead in each direction
+MAX_CACHED_SLICES = 64  # Display slices kept in memory
+
+# Uncompressed copies of .nii.gz inputs, so slices can be read through a memory map
+UNCOMPRESSED_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fatvit", "qc")
+MAX_UNCOMPRESSED_FILES = 8
+
+
+def load_matplotlib():
+    # Deferred until a viewer opens (or preloaded on the GUI's loader thread), matplotlib is the slowest import here
+    from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
+    from matplotlib.figure import Figure
+    from matplotlib import colormaps
+    return Figure, FigureCanvasQTAgg, colormaps
+
+
+def uncompressed_copy(path):
+    # Decompresses once into the cache, keyed by path, size and mtime so an edited file is refreshed
+    stat = os.stat(path)
+    key = hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()
+    cached_path = os.path.join(UNCOMPRESSED_CACHE_DIR, f"{key}.nii")
+    if os.path.exists(cached_path):
+        os.utime(cached_path)  # Most recently used
+        return cached_path
+
+    os.makedirs(UNCOMPRESSED_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+    with gzip.open(path, "rb") as src, open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+    os.replace(tmp_path, cached_path)
+
+    # Drop the least recently used copies
+    copies = sorted(
+        (os.path.join(UNCOMPRESSED_CACHE_DIR, f) for f in os.listdir(UNCOMPRESSED_CACHE_DIR) if f.endswith(".nii")),
+        key=os.path.getmtime, reverse=True,
+    )
+    for old_path in copies[MAX_UNCOMPRESSED_FILES:]:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+    return cached_path
+
+
+def open_volume(path):
+    # Array proxy that reads slices on demand in the file's native dtype. Uncompressed .nii is
+    # memory-mapped in place, .nii.gz goes through a cached uncompressed copy.
+    if path.endswith(".gz"):
+        try:
+            path = uncompressed_copy(path)
+        except OSError as e:
+            print(f"Could not cache an uncompressed copy of {path}, reading it compressed: {e}")
+    return nib.load(path, mmap=True).dataobj
+
+
+class SliceCache:
+    # Display-ready slices: the image as uint8 and the mask as a label map plus an RGBA overlay.
+    # Slices are built on demand, kept in a bounded LRU and neighbours of the current slice are
+    # prefetched in the background. volume / mask are arrays or nibabel array proxies.
+    def __init__(self, volume, mask, max_slices=MAX_CACHED_SLICES):
+        self.volume = volume
+        self.mask = mask
+        # Same colours the jet overlay gives labels 0..2
+        colormaps = load_matplotlib()[2]
+        self.overlay_lut = (colormaps["jet"](np.linspace(0, 1, NUM_LABELS)) * 255).astype(np.uint8)
+        self.overlay_lut[:, 3] = int(OVERLAY_ALPHA * 255)
+        self.slices = OrderedDict()
+        self.max_slices = max_slices
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = set()
+
+    def build(self, slice_idx):
+        img_slice = np.asarray(self.volume[:, :, slice_idx], dtype=np.float32).T
+        # Per-slice min/max window, matching imshow's autoscaling
+        low, high = float(img_slice.min()), float(img_slice.max())
+        scale = 255.0 / (high - low) if high > low else 0.0
+        img_u8 = ((img_slice - low) * scale).astype(np.uint8)
+        labels = np.clip(np.rint(np.asarray(self.mask[:, :, slice_idx]).T), 0, NUM_LABELS - 1).astype(np.uint8)
+        return img_u8, labels, self.overlay_lut[labels]
+
+    def get(self, slice_idx):
+        with self.lock:
+            cached = self.slices.get(slice_idx)
+            if cached is not None:
+                self.slices.move_to_end(slice_idx)
+        if cached is None:
+            cached = self.build(slice_idx)
+            with self.lock:
+                self.slices[slice_idx] = cached
+                while len(self.slices) > self.max_slices:
+                    self.slices.popitem(last=False)
+        return cached
+
+    def prefetch(self, slice_idx):
+        for offset in range(1, PREFETCH_SLICES + 1):
+            for idx in (slice_idx + offset, slice_idx - offset):
+                if 0 <= idx < self.volume.shape[2]:
+                    with self.lock:
+                        if idx in self.slices or idx in self.pending:
+                            continue
+                        self.pending.add(idx)
+                    self.executor.submit(self._prefetch_one, idx)
+
+    def _prefetch_one(self, slice_idx):
+        try:
+            self.get(slice_idx)
+        finally:
+            with self.lock:
+                self.pending.discard(slice_idx)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
 
-from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget, QSpinBox, QRadioButton, QButtonGroup, QGroupBox, QHBoxLayout, QPushButton, QFrame
-# from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QIcon
-from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
 
 class MainWindow(QMainWindow):
-    def __init__(self, nifti_image_path, mask_image_path):
+    def __init__(self, nifti_image_path, mask_image_path, volume=None, mask=None):
+        # volume / mask can be passed in already decoded (e.g. straight from the segmentation
+        # in main.py, in file orientation) to skip reading them back from disk
         super().__init__()
         self.setWindowTitle("1.3 - FatViT - Quality Check")
         self.setWindowIcon(QIcon("assets/ai_icon1.png"))
@@ -22,16 +145,26 @@ class MainWindow(QMainWindow):
         self.save_folder = os.path.dirname(mask_image_path)  # Save folder from predicted volume
         
         # Load NIfTI files
-        self.volume = nib.load(self.nifti_image_path).get_fdata()
-        self.mask = nib.load(self.mask_image_path).get_fdata()
+        self.volume = volume if volume is not None else open_volume(self.nifti_image_path)
+        self.mask = mask if mask is not None else open_volume(self.mask_image_path)
         self.slice_ratings_vat = [0] * self.volume.shape[2]  # Initialize VAT ratings with 0 (not rated)
         self.slice_ratings_sat = [0] * self.volume.shape[2]  # Initialize SAT ratings with 0 (not rated)
         self.final_rating_vat = None  # Initialize final VAT rating
         self.final_rating_sat = None  # Initialize final SAT rating
         
         # Create a figure instance to plot on
+        Figure, FigureCanvas, _ = load_matplotlib()
         self.figure = Figure(figsize=(10, 4), dpi=100)
         self.canvas = FigureCanvas(self.figure)
+        self.slice_cache = SliceCache(self.volume, self.mask)
+        self.create_artists()
+        
+        # Mouse wheel and arrow keys on the canvas, Page Up/Down anywhere in the window
+        self.canvas.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
+        self.canvas.mpl_connect("scroll_event", self.on_scroll)
+        self.canvas.mpl_connect("key_press_event", self.on_key_press)
+        QShortcut(QKeySequence("PgUp"), self).activated.connect(self.next_slice)
+        QShortcut(QKeySequence("PgDown"), self).activated.connect(self.prev_slice)
         
         # Create a spinbox to select slices
         self.slice_selector = QSpinBox()
@@ -151,38 +284,41 @@ class MainWindow(QMainWindow):
         # Initialize plot
         self.plot(self.volume.shape[2] // 2)
         
-    def plot(self, slice_idx):
-        # Clear previous figure
-        self.figure.clear()
-        
-        # Extract the specified slice
-        img_slice = self.volume[:, :, slice_idx]
-        mask_slice = self.mask[:, :, slice_idx]
+    def create_artists(self):
+        # Axes and images are created once, navigation only swaps their pixel data
+        img_u8, labels, overlay = self.slice_cache.get(self.volume.shape[2] // 2)
         
         # Adjust subplots to remove margins
         self.figure.subplots_adjust(left=0, right=1, top=1, bottom=0, wspace=0.01, hspace=0.01)
-    
         
         # Create subplots with no margins
         ax1 = self.figure.add_subplot(131)
         ax2 = self.figure.add_subplot(132)
         ax3 = self.figure.add_subplot(133)
         
-        # Plot volume slice
-        ax1.imshow(img_slice.T, cmap='gray', origin='lower')
+        # Volume slice
+        self.img_artist = ax1.imshow(img_u8, cmap='gray', origin='lower', vmin=0, vmax=255)
         ax1.axis('off')
-    
-        # Plot mask slice
-        ax2.imshow(mask_slice.T, cmap='gray', origin='lower')
+        
+        # Mask slice
+        self.mask_artist = ax2.imshow(labels, cmap='gray', origin='lower', vmin=0, vmax=NUM_LABELS - 1)
         ax2.axis('off')
-    
-        # Plot overlay
-        ax3.imshow(img_slice.T, cmap='gray', origin='lower', interpolation='none')
-        ax3.imshow(mask_slice.T, cmap='jet', origin='lower', interpolation='none', alpha=0.7)
+        
+        # Overlay
+        self.overlay_img_artist = ax3.imshow(img_u8, cmap='gray', origin='lower', interpolation='none', vmin=0, vmax=255)
+        self.overlay_artist = ax3.imshow(overlay, origin='lower', interpolation='none')
         ax3.axis('off')
     
-        # Refresh canvas
+    def plot(self, slice_idx):
+        img_u8, labels, overlay = self.slice_cache.get(slice_idx)
+        self.img_artist.set_data(img_u8)
+        self.mask_artist.set_data(labels)
+        self.overlay_img_artist.set_data(img_u8)
+        self.overlay_artist.set_data(overlay)
+    
+        # Refresh canvas, rapid slice changes are coalesced into one draw
         self.canvas.draw_idle()
+        self.slice_cache.prefetch(slice_idx)
     
         # Update radio button selection based on saved rating
         rating_vat = self.slice_ratings_vat[slice_idx]
@@ -208,6 +344,24 @@ class MainWindow(QMainWindow):
     def update_plot(self, value):
         self.plot(value)
     
+    def on_scroll(self, event):
+        step = int(round(event.step)) or (1 if event.button == "up" else -1)
+        self.slice_selector.setValue(self.slice_selector.value() + step)  # Clamped to the range by the spinbox
+    
+    def on_key_press(self, event):
+        if event.key in ("right", "up"):
+            self.next_slice()
+        elif event.key in ("left", "down"):
+            self.prev_slice()
+        elif event.key == "home":
+            self.slice_selector.setValue(self.slice_selector.minimum())
+        elif event.key == "end":
+            self.slice_selector.setValue(self.slice_selector.maximum())
+    
+    def closeEvent(self, event):
+        self.slice_cache.shutdown()
+        super().closeEvent(event)
+    
     def prev_slice(self):
         current_value = self.slice_selector.value()
         if current_value > self.slice_selector.minimum():
@@ -267,4 +421,4 @@ if __name__ == '__main__':
         stylesheet = file.read()
         app.setStyleSheet(stylesheet)
         window.show()
-    sys.exit(app.exec_())
+    sys.exit(app.exec())
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import dataclasses
+
+import inference
+
+# On-disk cache of segmentation results, keyed by content rather than file names.
+#
+# The key hashes the input NIfTI bytes, the model weights and every inference setting that can
+# change the output. A hit restores the saved mask (and probabilities) into the output folder and
+# returns the stored metrics without loading the model. Entries are evicted least recently used
+# first once the cache grows past its size limit.
+
+CACHE_DIR = os.environ.get("FATVIT_RESULT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "fatvit", "results"))
+MAX_CACHE_BYTES = int(float(os.environ.get("FATVIT_RESULT_CACHE_MB", 5 * 1024)) * 2**20)
+ENABLED = os.environ.get("FATVIT_RESULT_CACHE", "1") != "0"
+CACHE_VERSION = 2  # Bump when the stored layout or the meaning of a key changes
+
+# Settings that only affect speed, results are the same with any value
+SPEED_ONLY_SETTINGS = ("sw_batch_size", "num_threads")
+
+# Digests of large files, reused while size and mtime are unchanged: {path: (size, mtime_ns, digest)}
+_digests = {}
+_digests_lock = threading.Lock()
+_store_lock = threading.Lock()
+
+
+def file_digest(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with _digests_lock:
+        cached = _digests.get(path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(4 * 1024 * 1024), b""):
+            digest.update(block)
+    digest = digest.hexdigest()
+    with _digests_lock:
+        _digests[path] = (stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+
+def cache_key(nii_path, model_path, settings=None):
+    settings = settings or inference.InferenceSettings()
+    output_settings = {k: v for k, v in dataclasses.asdict(settings).items() if k not in SPEED_ONLY_SETTINGS}
+    description = json.dumps({
+        "version": CACHE_VERSION,
+        "input": file_digest(nii_path),
+        "model": file_digest(model_path),
+        "arch": inference.model_arch,
+        "patch_size": inference.patch_size,
+        "settings": output_settings,
+    }, sort_keys=True, default=list)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def _entry_dir(key):
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+
+def _entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+
+
+def lookup(key, nii_path, save_path):
+    # Restores a cached result into save_path and returns it in segment_file's format, None on a miss
+    entry_dir = _entry_dir(key)
+    try:
+        with open(os.path.join(entry_dir, "result.json"), "r") as file:
+            stored = json.load(file)
+        os.makedirs(save_path, exist_ok=True)
+        mask_path = inference.predicted_mask_path(save_path, nii_path)
+        shutil.copyfile(os.path.join(entry_dir, "pred.nii"), mask_path)
+        if os.path.exists(os.path.join(entry_dir, "prob.nii")):
+            shutil.copyfile(os.path.join(entry_dir, "prob.nii"), inference.predicted_prob_path(save_path, nii_path))
+    except (OSError, ValueError):
+        return None  # Missing, evicted mid-read or corrupt entries are just misses
+    os.utime(entry_dir)  # Most recently used
+
+    metrics = stored["metrics"]
+    inference.save_metrics(metrics, inference.metrics_path(mask_path))
+    return {
+        "nii_path": nii_path,
+        "mask_path": mask_path,
+        "metrics_path": inference.metrics_path(mask_path),
+        "vat_volume": metrics["vat_cm3"],
+        "sat_volume": metrics["sat_cm3"],
+        "vat_sat_ratio": metrics["vat_sat_ratio"],
+        "metrics": metrics,
+        "inference_time": stored["inference_time"],
+        "cached": True,
+        # Not decoded on a hit, the quality check reads the files instead
+        "volume": None,
+        "mask": None,
+    }
+
+
+def store(key, result):
+    entry_dir = _entry_dir(key)
+    tmp_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        shutil.copyfile(result["mask_path"], os.path.join(tmp_dir, "pred.nii"))
+        prob_path = inference.predicted_prob_path(os.path.dirname(result["mask_path"]), result["nii_path"])
+        if os.path.exists(prob_path):
+            shutil.copyfile(prob_path, os.path.join(tmp_dir, "prob.nii"))
+        with open(os.path.join(tmp_dir, "result.json"), "w") as file:
+            json.dump({"metrics": result["metrics"], "inference_time": result["inference_time"], "stored": time.time()}, file)
+        with _store_lock:
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+            evict()
+    except OSError as e:
+        print(f"Could not store result in cache: {e}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def evict(max_bytes=None):
+    # Removes least recently used entries until the cache fits in max_bytes
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for prefix in os.listdir(CACHE_DIR):
+        prefix_dir = os.path.join(CACHE_DIR, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for name in os.listdir(prefix_dir):
+            entry_dir = os.path.join(prefix_dir, name)
+            if name.endswith(".tmp") or not os.path.isdir(entry_dir):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry_dir), _entry_size(entry_dir), entry_dir))
+            except OSError:
+                continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+
+
+def segment_file(nii_path, model_path, save_path, progress_callback=None, cancel_event=None, settings=None, model=None, timer=None, keep_volume=False):
+    # inference.segment_file behind the cache, the model is only loaded on a miss.
+    # model: an already loaded model (or stand-in) for model_path to use instead
+    # timer: optional instrumentation.CaseTimer, keep_volume: see inference.segment_file
+    settings = settings or inference.InferenceSettings()
+    key = None
+    if ENABLED:
+        with inference.timed_stage(timer, "cache_lookup"):
+            key = cache_key(nii_path, model_path, settings)
+            result = lookup(key, nii_path, save_path)
+        if result is not None:
+            if timer is not None:
+                timer.counts["cached"] = True
+            return result
+
+    if model is None:
+        with inference.timed_stage(timer, "model_load"):  # Close to zero once the model is cached
+            model = inference.get_model(model_path, precision=settings.precision)
+    result = inference.segment_file(nii_path, model, save_path, progress_callback, cancel_event, settings, timer, keep_volume)
+    if key is not None:
+        with inference.timed_stage(timer, "cache_store"):
+            store(key, result)
+    if timer is not None:
+        timer.counts["cached"] = False
+    result["cached"] = False
+    return result
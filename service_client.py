@@ -0,0 +1,43 @@
+import os
+import json
+import urllib.error
+import urllib.request
+
+# Thin client of inference_service.py. Only uses the standard library, so callers don't need torch or MONAI.
+# The GUI sends its segmentations to the service when FATVIT_SERVICE_URL is set, e.g.
+#   FATVIT_SERVICE_URL=http://127.0.0.1:8765 python main.py
+
+SERVICE_URL = os.environ.get("FATVIT_SERVICE_URL", "")
+
+
+class ServiceError(RuntimeError):
+    pass
+
+
+def _request(url, path, payload=None, timeout=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(url.rstrip("/") + path, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.load(e).get("error", str(e))
+        except ValueError:
+            message = str(e)
+        raise ServiceError(message)
+    except urllib.error.URLError as e:
+        raise ServiceError(f"FatViT service at {url} is not reachable: {e.reason}")
+
+
+def health(url=None, timeout=5):
+    return _request(url or SERVICE_URL, "/health", timeout=timeout)
+
+
+def segment(nii_path, save_path, model_path=None, url=None, timeout=None):
+    # Blocks until the service has segmented the volume, returns its result dict (volumes, paths, timings).
+    # Paths are sent as absolute paths, the service reads and writes them on the same machine.
+    payload = {"input": os.path.abspath(nii_path), "output": os.path.abspath(save_path)}
+    if model_path:
+        payload["model"] = os.path.abspath(model_path)
+    return _request(url or SERVICE_URL, "/segment", payload, timeout=timeout)